@@ -1,84 +1,146 @@
-from flask import Flask, render_template, request
+from flask import Blueprint, Flask, render_template, request, send_file, abort, Response, stream_with_context
+import atexit
+import gc
 import json
-import os
-
-# Creating the app and loading api keys 
-app = Flask(__name__)
-with open("api_keys.json", "r") as file:
-    keys = json.load(file)
-    tih_api_key = keys["TIH"]
-    if 'GoogleAPI' in keys:
-        google_api_key = keys["GoogleAPI"]
-    else:
-        google_api_key = None
-    openai_api_key = keys["OpenAI"]
-    os.environ["OPENAI_API_KEY"] = openai_api_key
-    model = keys["LLMModel"]
-    download_images = keys['download_places_image']
-    max_tih_cache_age = keys["MaxCacheAgeTIHDataset"]
-
+import queue
+import threading
+import uuid
 
-from enrich_places_api.cache_json import JsonFileCache
-from enrich_places_api.places_lookup_google import GooglePlacesLookup
-from llm_api.llm_queries_openai import OpenAILLMQueries
 from llm_api.llm_models import LLMResponseType
-from tih_api.tih_api import TIHAPI
-from tih_api.format_api_response import format_api_response
+from tih_api.format_api_response import clean_text
+from common.metrics import REGISTRY
+from common.conversation_store import Conversation
+from services import Services
 import re
 from datetime import datetime
 
 
-# For now I am just going to store the conversation. This should be replaced eventually, but good enough for poc
-ai_conversation = []
-view_conversation = []
-cache = JsonFileCache('places_cache.json', 'places_cache_requests.json')
-places_look_up = GooglePlacesLookup(google_api_key, cache, download_images)
-tih_api = TIHAPI(tih_api_key, places_look_up, "tih_datasets_cache.json", max_tih_cache_age)
-llm = OpenAILLMQueries(openai_api_key, model)
-
-
-def append_to_conversation(data: dict):
-    ai_conversation.append(data)
-    view_conversation.append(data)
-
-
-def collect_data_and_respond():
-    api_response = llm.collect_user_data(ai_conversation)
+views = Blueprint("views", __name__)
+# set by create_app, the api clients and caches are built on first use
+services: Services | None = None
+SESSION_COOKIE = "tih_session"
+
+
+def create_app(keys_file: str = "api_keys.json", preload: bool = False, workers: int = 1) -> Flask:
+    """Creates the app from the api keys file.
+
+    With preload the places cache and the other caches are loaded right away. This is meant for a server which
+    forks its workers afterwards, they share the loaded data copy-on-write. Every worker has to call
+    services.claim() after the fork to close the services on exit, see gunicorn.conf.py.
+    workers is the number of worker processes, more than one needs the sqlite places cache.
+    """
+    global services
+    with open(keys_file, "r") as file:
+        services = Services(json.load(file), workers)
+    atexit.register(services.close)
+
+    if preload:
+        services.preload()
+        services.release()
+        # objects created before the fork are never collected by the workers, which keeps their pages shared
+        gc.freeze()
+
+    app = Flask(__name__)
+    app.register_blueprint(views)
+    return app
+
+
+def append_to_conversation(conversation: Conversation, data: dict):
+    conversation.ai_conversation.append(data)
+    conversation.view_conversation.append(data)
+
+
+class AnswerStream:
+    """Forwards a streamed llm answer as events. Text before the first empty line is sent as 'header',
+    the remaining text as 'recommendation'. Markdown bold markers are removed like for the complete answer."""
+
+    def __init__(self, emit):
+        self._emit = emit
+        self._text = ""
+        self._sent = 0
+        self._in_header = True
+
+    def feed(self, text: str):
+        self._text = self._text + text
+        cleaned = self._text.replace("**", "")
+        # a trailing '*' may be the first half of a bold marker
+        end = len(cleaned) - 1 if cleaned.endswith("*") else len(cleaned)
+
+        if self._in_header:
+            match = re.search(r'\r?\n\s*\n', cleaned[:end])
+            if match is None:
+                # hold back trailing whitespace, it may become the separator to the first recommendation
+                stripped_end = len(cleaned[:end].rstrip())
+                if "\n" in cleaned[stripped_end:end]:
+                    end = stripped_end
+                self._send("header", cleaned, end)
+                return
+
+            self._send("header", cleaned, match.start())
+            self._in_header = False
+            self._sent = match.end()
+
+        self._send("recommendation", cleaned, end)
+
+    def reset(self, status: str):
+        """Discards the streamed text, e.g. when the llm decided to call a function instead of answering"""
+        self._text = ""
+        self._sent = 0
+        self._in_header = True
+        self._emit("reset", status)
+
+    def _send(self, event: str, cleaned: str, end: int):
+        if end > self._sent:
+            self._emit(event, cleaned[self._sent:end])
+            self._sent = end
+
+
+def collect_data_and_respond(conversation: Conversation, stream: AnswerStream | None = None):
+    on_text = stream.feed if stream is not None else None
+    api_response = services.llm.collect_user_data(conversation.ai_conversation, on_text=on_text)
     print(f"api_response: {api_response}")
     if api_response.response_type == LLMResponseType.TEXT:
         llm_answer = api_response.response_text.replace("**", "")
-        append_to_conversation({"role": "assistant", "content": llm_answer})
+        append_to_conversation(conversation, {"role": "assistant", "content": llm_answer})
     else:
-        create_recommendation_response(api_response)
+        if stream is not None:
+            stream.reset("Searching for recommendations...")
+        create_recommendation_response(conversation, api_response, stream)
 
 
-def create_recommendation_response(api_response):
-    datasets = tih_api.get_datasets()
-    datasets = llm.filter_datasets(ai_conversation, datasets)
+def create_recommendation_response(conversation: Conversation, api_response, stream: AnswerStream | None = None):
+    datasets = services.tih_api.get_datasets()
+    if services.combined_query_analysis:
+        datasets, keywords = services.llm.select_datasets_and_keywords(conversation.ai_conversation, datasets)
+    else:
+        datasets = services.llm.filter_datasets(conversation.ai_conversation, datasets)
+        keywords = services.llm.get_query_keywords(conversation.ai_conversation)
     print(f"selected datasets: {datasets}")
-    keywords = llm.get_query_keywords(ai_conversation)
     print(f"keywords: {keywords}")
     print(api_response.response_function_arguments)
     start_date = datetime.strptime(api_response.response_function_arguments["tripStartDate"], '%Y-%m-%d')
     end_date = datetime.strptime(api_response.response_function_arguments["tripEndDate"], '%Y-%m-%d')
-    dk_api_responses_raw = tih_api.multiple_datasets_by_keywords(datasets, keywords, 25, start_date, end_date)
-    dk_api_responses = [format_api_response(response) for response in dk_api_responses_raw]
-    if len(dk_api_responses) == 0:
+    dk_api_responses_raw = services.tih_api.multiple_datasets_by_keywords(datasets, keywords, 25, start_date, end_date)
+    # the tool message stays in the conversation, only the best results within the token budget are sent
+    tool_content, dk_api_responses_raw = services.tool_payload.build(dk_api_responses_raw, keywords)
+    if len(dk_api_responses_raw) == 0:
         print("No data found LLM will response on it's own")
-        dk_api_responses = ["Sorry, I was unable to find suitable results."]
+        tool_content = "Sorry, I was unable to find suitable results."
     else:
-        print(f"dk_api_responses: {dk_api_responses}")
+        print(f"tool content: {tool_content}")
 
     tool_responses = format_results(dk_api_responses_raw)
-    append_to_conversation({"role": "assistant", "tool_calls": api_response.response_tool_data})
-    append_to_conversation(
-        {"role": "tool", "tool_call_id": api_response.response_tool_id, "content": "\n\n".join(dk_api_responses)})
-    print(ai_conversation)
-    create_response_from_tool_data(tool_responses)
+    append_to_conversation(conversation, {"role": "assistant", "tool_calls": api_response.response_tool_data})
+    append_to_conversation(conversation,
+        {"role": "tool", "tool_call_id": api_response.response_tool_id, "content": tool_content})
+    print(conversation.ai_conversation)
+    create_response_from_tool_data(conversation, tool_responses, stream)
 
 
-def create_response_from_tool_data(tool_responses):
-    api_response = llm.collect_user_data(ai_conversation)
+def create_response_from_tool_data(conversation: Conversation, tool_responses, stream: AnswerStream | None = None):
+    # the answer is split into header, recommendations and footer once it is complete
+    on_text = stream.feed if stream is not None else None
+    api_response = services.llm.collect_user_data(conversation.ai_conversation, on_text=on_text)
     if api_response.response_type == LLMResponseType.TEXT:
         llm_answer = api_response.response_text.replace("**", "")
         answer_parts = re.split(r'\r?\n\s*\n', llm_answer)
@@ -94,8 +156,8 @@ def create_response_from_tool_data(tool_responses):
         data["response_footer"] = answer_parts[len(answer_parts) - 1]
         data["response_data"] = selected_responses
         print(f"final tool response: {data}")
-        ai_conversation.append({'role': "assistant", 'content': llm_answer})
-        view_conversation.append(data)
+        conversation.ai_conversation.append({'role': "assistant", 'content': llm_answer})
+        conversation.view_conversation.append(data)
 
 
 def get_cleaned_selection(answer_parts: list[str]) -> list[str]:
@@ -139,47 +201,125 @@ def format_result(api_response):
     response['Website'] = api_response['officialWebsite']
     response['Address'] = f"{api_response['address']['block']} {api_response['address']['streetName']}, Singapore {api_response['address']['postalCode']}".strip()
     response['Rating'] = api_response['rating']
-    if 'google_data' in api_response:
-        image_path = f"static/image_cache/{api_response['google_data']['place_id']}"
-        if os.path.exists(image_path):
-            response['Image'] = image_path
-        else:
-            # random fallback image :)
-            response['Image'] = f"static/image_cache/ChIJzXNvOzcY2jERZ6JJC0ab_qg"
-    else:
-        response['Image'] = f"static/image_cache/ChIJzXNvOzcY2jERZ6JJC0ab_qg"
+    # random fallback image :)
+    image_place_id = "ChIJzXNvOzcY2jERZ6JJC0ab_qg"
+    if 'google_data' in api_response and services.image_variants.has_image(api_response['google_data']['place_id']):
+        image_place_id = api_response['google_data']['place_id']
+
+    response['Image'] = f"images/card/{image_place_id}"
+    response['DetailImage'] = f"images/detail/{image_place_id}"
 
     response['Price'] = '999'
     return response
 
 
-def clean_text(text):
-    text = text.replace("\n", " ")
-    regex = r"<.*?>"
-    text = re.sub(regex, "", text)
-    regex = r"[^\x00-\x7F]"
-    return re.sub(regex, "", text)
+def get_session_id() -> str:
+    session_id = request.cookies.get(SESSION_COOKIE)
+    if session_id is None or len(session_id) != 32 or not session_id.isalnum():
+        session_id = uuid.uuid4().hex
+    return session_id
+
+
+def with_session_cookie(response: Response, session_id: str) -> Response:
+    response.set_cookie(SESSION_COOKIE, session_id, max_age=services.session_idle_timeout, httponly=True, samesite="Lax")
+    return response
 
 
-@app.route("/", methods=["GET", "POST"])
+@views.route("/", methods=["GET", "POST"])
 def handle_query_other():
+    session_id = get_session_id()
+    conversation = services.conversation_store.load(session_id)
     if request.method == "POST":
         user_query = request.form["user_input"]
-        append_to_conversation({"role": "user", "content": user_query})
-        collect_data_and_respond()
+        append_to_conversation(conversation, {"role": "user", "content": user_query})
+        collect_data_and_respond(conversation)
+        services.conversation_store.save(session_id, conversation)
+
+    response = Response(render_template("index.html", conversations=conversation.view_conversation))
+    return with_session_cookie(response, session_id)
+
+
+@views.route("/stream", methods=["POST"])
+def handle_query_stream():
+    """Same as posting to / but the answer is sent as server-sent events while the llm generates it.
+    Events: 'user' and 'done' contain the rendered conversation items, 'header', 'recommendation' and 'reset'
+    contain text, 'error' the error message."""
+    user_query = request.form["user_input"]
+    session_id = get_session_id()
+    conversation = services.conversation_store.load(session_id)
+    events = queue.Queue()
+
+    def emit(event: str, data: str):
+        events.put((event, data))
+
+    def respond():
+        try:
+            collect_data_and_respond(conversation, AnswerStream(emit))
+            services.conversation_store.save(session_id, conversation)
+            emit("done", "")
+        except Exception as e:
+            print(f"streamed response failed: {e}")
+            emit("error", "Sorry, something went wrong. Please try again.")
+
+    def generate():
+        user_data = {"role": "user", "content": user_query}
+        append_to_conversation(conversation, user_data)
+        yield format_server_sent_event("user", render_template("response_item.html", conversation=user_data))
+        threading.Thread(target=respond, daemon=True).start()
+        while True:
+            event, data = events.get()
+            if event == "done":
+                data = render_template("response_item.html", conversation=conversation.view_conversation[-1])
+
+            yield format_server_sent_event(event, data)
+            if event == "done" or event == "error":
+                return
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return with_session_cookie(response, session_id)
+
+
+def format_server_sent_event(event: str, data: str) -> str:
+    # json keeps the data on a single line
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@views.route("/images/<variant>/<place_id>", methods=["GET"])
+def handle_image(variant, place_id):
+    image_path = services.image_variants.get_variant_path(place_id, variant)
+    if image_path is None:
+        abort(404)
+
+    # cached images never change for a place id, so browsers may keep them
+    mimetype = "image/webp" if image_path.endswith(".webp") else "image/jpeg"
+    return send_file(image_path, mimetype=mimetype, max_age=services.image_cache_max_age, etag=True, conditional=True)
+
+
+@views.route("/reset", methods=["GET"])
+def handle_reset():
+    session_id = get_session_id()
+    services.conversation_store.delete(session_id)
 
-    return render_template("index.html", conversations=view_conversation)
+    response = Response(render_template("index.html", conversations=list()))
+    return with_session_cookie(response, session_id)
 
 
-@app.route("/reset", methods=["GET"])
-def handle_reset():
-    global ai_conversation
-    global view_conversation
-    ai_conversation = []
-    view_conversation = []
+@views.route("/metrics", methods=["GET"])
+def handle_metrics():
+    # prometheus text format, the metrics are kept per worker process
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
 
-    return render_template("index.html", conversations=view_conversation)
+@views.route("/ready", methods=["GET"])
+def handle_ready():
+    # ready once the places cache is loaded, the first request would load it otherwise
+    ready = services.is_ready()
+    if not ready:
+        services.start_warm_up()
+    body = json.dumps({'ready': ready, 'components': services.get_built_components()})
+    return Response(body, status=200 if ready else 503, mimetype="application/json")
 
 
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
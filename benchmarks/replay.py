@@ -0,0 +1,182 @@
+"""Local stand-ins for the TIH, Google places and OpenAI clients which replay the recorded responses in
+benchmarks/fixtures, and generators for places caches and TIH records of any size based on them."""
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+import copy
+import json
+import os
+import random
+import threading
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# roughly the area of singapore
+_LATITUDE_RANGE = (1.24, 1.45)
+_LONGITUDE_RANGE = (103.64, 103.99)
+_NAME_WORDS = ("golden", "lotus", "kitchen", "garden", "heritage", "marina", "harbour", "spice", "house", "corner",
+               "noodle", "bar", "market", "museum", "studio", "gallery", "tea", "kopi", "bay", "hill")
+_STREETS = ("Raffles Quay", "Marina Gardens Drive", "North Bridge Road", "Orchard Road", "Arab Street",
+            "Tanjong Pagar Road", "Serangoon Road", "East Coast Parkway", "Upper Thomson Road", "Jurong West Street")
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), "r") as file:
+        return json.load(file)
+
+
+class ReplayResponse:
+    def __init__(self, data: dict, status_code: int = 200):
+        self.status_code = status_code
+        self._data = data
+
+    def json(self) -> dict:
+        return self._data
+
+    def raise_for_status(self):
+        pass
+
+
+class ReplayTIHSession:
+    """Replaces the requests session of TIHAPI. Search requests are answered with pages of the given records,
+    filtered by dataset."""
+
+    def __init__(self, records: list[dict], datasets: list[str]):
+        self._records = records
+        self._datasets = datasets
+        self.request_count = 0
+        self.adapters = dict()
+
+    def get(self, url: str, headers: dict = None, params: dict = None, timeout=None) -> ReplayResponse:
+        self.request_count = self.request_count + 1
+        if url.endswith("/datasets"):
+            return ReplayResponse({'data': self._datasets})
+
+        datasets = [dataset.strip() for dataset in params['dataset'].split(",")]
+        records = [record for record in self._records if record['dataset'] in datasets]
+        offset = params['offset']
+        return ReplayResponse({'data': copy.deepcopy(records[offset:offset + params['limit']])})
+
+
+class ReplayGoogleClient:
+    """Replaces the googlemaps client of GooglePlacesLookup. A text search returns the recorded results moved to
+    the searched location, so nothing new is ever matched by accident."""
+
+    def __init__(self):
+        self._text_search = load_fixture("google_text_search")
+        self._details = load_fixture("google_place_details")
+        self._lock = threading.Lock()
+        self.calls = {'places': 0, 'place': 0, 'places_photo': 0}
+
+    def places(self, query: str = None, location: dict = None, radius: int = None, page_token: str = None) -> dict:
+        with self._lock:
+            self.calls['places'] = self.calls['places'] + 1
+            search_id = self.calls['places']
+
+        response = copy.deepcopy(self._text_search)
+        response.pop('next_page_token', None)
+        for index, result in enumerate(response['results']):
+            result['place_id'] = f"{result['place_id']}-search-{search_id}"
+            result['reference'] = result['place_id']
+            result['geometry']['location'] = {'lat': location['lat'] + 0.001 * index,
+                                              'lng': location['lng'] - 0.001 * index}
+        return response
+
+    def place(self, place_id: str) -> dict:
+        with self._lock:
+            self.calls['place'] = self.calls['place'] + 1
+        response = copy.deepcopy(self._details)
+        response['result']['place_id'] = place_id
+        response['result']['reference'] = place_id
+        return response
+
+    def places_photo(self, photo_reference: str, max_width: int = None, max_height: int = None):
+        with self._lock:
+            self.calls['places_photo'] = self.calls['places_photo'] + 1
+        return iter([b"\xff\xd8\xff\xd9"])
+
+
+class _ReplayCompletions:
+    def __init__(self, completions: dict, streamed_completions: dict):
+        self._completions = completions
+        self._streamed_completions = streamed_completions
+        self.calls = 0
+
+    def create(self, model: str = None, messages: list = None, tools=None, tool_choice=None, stream: bool = False,
+               **kwargs) -> ChatCompletion:
+        self.calls = self.calls + 1
+        if stream:
+            return self._create_stream(messages, tools)
+
+        if isinstance(tool_choice, dict):
+            return ChatCompletion.model_validate(self._completions[tool_choice['function']['name']])
+        if isinstance(tools, list) and len(tools) > 0:
+            return ChatCompletion.model_validate(self._completions[tools[0]['function']['name']])
+        return ChatCompletion.model_validate(self._completions['text'])
+
+    def _create_stream(self, messages: list, tools):
+        # the chat is streamed with the tools offered, after the tool results it answers with the recommendations
+        if isinstance(tools, list) and len(tools) > 0 and messages[-1]['role'] != "tool":
+            chunks = self._streamed_completions[tools[0]['function']['name']]
+        else:
+            chunks = self._streamed_completions['text']
+        return (ChatCompletionChunk.model_validate(chunk) for chunk in chunks)
+
+
+class _ReplayChat:
+    def __init__(self, completions: dict, streamed_completions: dict):
+        self.completions = _ReplayCompletions(completions, streamed_completions)
+
+
+class ReplayOpenAIClient:
+    """Replaces the OpenAI client of OpenAILLMQueries. Forced and offered tools are answered with the recorded
+    tool call of that function, everything else with the recorded text completion. Streamed requests replay the
+    recorded chunks, the answer to a tool result is the recommendation text."""
+
+    def __init__(self):
+        self.chat = _ReplayChat(load_fixture("openai_completions"), load_fixture("openai_completions_stream"))
+
+
+def generate_places(count: int, seed: int = 0) -> list[dict]:
+    """Creates count google places in the recorded text search format spread over singapore"""
+    rng = random.Random(seed)
+    templates = load_fixture("google_text_search")['results']
+    places = list[dict]()
+    for index in range(count):
+        place = copy.deepcopy(templates[index % len(templates)])
+        place['place_id'] = f"{place['place_id']}-{index}"
+        place['reference'] = place['place_id']
+        place['name'] = " ".join(rng.sample(_NAME_WORDS, 3)).title()
+        place['formatted_address'] = f"{rng.randint(1, 999)} {rng.choice(_STREETS)}, " \
+                                     f"Singapore {rng.randint(10000, 829999):06d}"
+        place['geometry']['location'] = {'lat': rng.uniform(*_LATITUDE_RANGE), 'lng': rng.uniform(*_LONGITUDE_RANGE)}
+        place['rating'] = round(rng.uniform(3.0, 5.0), 1)
+        place['user_ratings_total'] = rng.randint(0, 2000)
+        place['cachedAt'] = "01-04-24 12:00:00"
+        places.append(place)
+    return places
+
+
+def generate_tih_records(places: list[dict], count: int, match_ratio: float = 0.8, seed: int = 0) -> list[dict]:
+    """Creates count TIH records in the recorded search format. About match_ratio of them describe one of the
+    given places, the rest have no google place."""
+    rng = random.Random(seed)
+    templates = load_fixture("tih_search")['data']
+    records = list[dict]()
+    for index in range(count):
+        record = copy.deepcopy(templates[index % len(templates)])
+        record['uuid'] = f"bench{index:08d}"
+        if rng.random() < match_ratio:
+            place = rng.choice(places)
+            block, street = place['formatted_address'].split(",")[0].split(" ", 1)
+            record['name'] = place['name']
+            latitude = place['geometry']['location']['lat'] + rng.uniform(-0.0005, 0.0005)
+            longitude = place['geometry']['location']['lng'] + rng.uniform(-0.0005, 0.0005)
+        else:
+            block, street = str(rng.randint(1, 999)), rng.choice(_STREETS)
+            record['name'] = f"{' '.join(rng.sample(_NAME_WORDS, 2)).title()} Pop-up {index}"
+            latitude, longitude = rng.uniform(*_LATITUDE_RANGE), rng.uniform(*_LONGITUDE_RANGE)
+
+        record['address']['block'] = block
+        record['address']['streetName'] = street
+        record['location'] = {'latitude': latitude, 'longitude': longitude}
+        records.append(record)
+    return records
@@ -0,0 +1,255 @@
+"""Offline benchmark of the recommendation pipeline.
+
+Replays the recorded TIH, Google places and OpenAI responses in benchmarks/fixtures through local stand-ins, no
+api keys or network access are needed. Every stage is timed at several places cache sizes and the results are
+written as json, so two versions can be compared with a plain diff.
+
+Usage:
+    python -m benchmarks.run_benchmarks [--sizes 1000 10000 50000] [--records 200] [--repeat 5]
+                                        [--output bench_output.json]
+"""
+import argparse
+import contextlib
+import copy
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_DIR not in sys.path:
+    sys.path.insert(0, REPOSITORY_DIR)
+
+from benchmarks.replay import (ReplayGoogleClient, ReplayOpenAIClient, ReplayTIHSession, generate_places,
+                               generate_tih_records)
+from enrich_places_api.cache_json import JsonFileCache
+from enrich_places_api.places_lookup_google import GooglePlacesLookup
+from llm_api.llm_queries_openai import OpenAILLMQueries
+from tih_api.tih_api import TIHAPI
+
+DATASETS = ["accommodation", "attractions", "bars_clubs", "events", "food_beverages", "shops", "tours"]
+CONVERSATION = [
+    {"role": "user", "content": "I want to try local food in Singapore."},
+    {"role": "assistant", "content": "When are you visiting Singapore?"},
+    {"role": "user", "content": "From the 2nd to the 9th of May, with my partner. We both love satay."}
+]
+# the conversation after the recommendation tool call, answered with the streamed recommendations
+TOOL_CONVERSATION = CONVERSATION + [
+    {"role": "assistant", "tool_calls": [{"id": "call_bench0102", "type": "function", "function": {
+        "name": "getRecommendations", "arguments": "{}"}}]},
+    {"role": "tool", "tool_call_id": "call_bench0102", "content": "Lau Pa Sat\nA historic hawker centre."}
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation pipeline with recorded responses.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 50000], help="places cache sizes")
+    parser.add_argument("--records", type=int, default=200, help="number of TIH records enriched per run")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage")
+    parser.add_argument("--workers", type=int, default=1, help="enrichment workers of TIHAPI")
+    parser.add_argument("--compact-records", action="store_true", help="keep the cached places as PlaceRecord")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated places and records")
+    parser.add_argument("--workdir", help="directory for the generated cache files, defaults to a temporary one")
+    parser.add_argument("--output", help="file to write the results to, defaults to stdout")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the measured code")
+    return parser.parse_args()
+
+
+def measure(function, repeat: int, operations: int = 1, setup=None) -> dict:
+    """Runs function repeat times and returns the timings in milliseconds. If setup is given its result is
+    passed to function and the time spent in setup is not measured."""
+    samples = list[float]()
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        if setup is not None:
+            function(argument)
+        else:
+            function()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    samples.sort()
+    median = statistics.median(samples)
+    return {
+        'samples': len(samples),
+        'operations': operations,
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(median, 3),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(0.95 * len(samples)))], 3),
+        'max_ms': round(samples[-1], 3),
+        'per_operation_us': round(median * 1000 / operations, 3)
+    }
+
+
+def progress(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def prepare_workdir(workdir: str):
+    """app.py and TIHAPI read their files from the working directory"""
+    with open(os.path.join(workdir, "api_keys.json"), "w") as file:
+        file.write(json.dumps({"TIH": "bench", "OpenAI": "bench", "GoogleAPI": "", "LLMModel": "gpt-4-turbo",
+                               "MaxCacheAgeTIHDataset": 60000, "download_places_image": False}))
+    with open(os.path.join(workdir, "tih_datasets_cache.json"), "w") as file:
+        file.write(json.dumps({'cache_data': DATASETS,
+                               'cachedAt': datetime.datetime.today().strftime("%d-%m-%y %H:%M:%S")}))
+    with open(os.path.join(workdir, "places_cache.json"), "w") as file:
+        file.write("{}")
+
+
+def benchmark_cache_size(size: int, args) -> dict:
+    places_data = generate_places(size, args.seed)
+    records = generate_tih_records(places_data, args.records, seed=args.seed)
+    cache_file = f"bench_places_{size}.json"
+    requests_file = f"bench_places_{size}_requests.json"
+    for file_path in (cache_file, requests_file, f"{cache_file}.journal"):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    with open(cache_file, "w") as file:
+        file.write(json.dumps({'cache_data': places_data}, indent=4))
+    del places_data
+
+    stages = dict()
+    stages['json_load'] = measure(
+        lambda: JsonFileCache(cache_file, requests_file, compact_records=args.compact_records).load_cache(),
+        args.repeat)
+    snapshot_file = f"bench_places_{size}.snapshot"
+    if os.path.exists(snapshot_file):
+        os.remove(snapshot_file)
+    # the first load writes the snapshot
+    JsonFileCache(cache_file, requests_file, compact_records=args.compact_records,
+                  snapshot_path=snapshot_file).load_cache()
+    stages['snapshot_load'] = measure(
+        lambda: JsonFileCache(cache_file, requests_file, compact_records=args.compact_records,
+                              snapshot_path=snapshot_file).load_cache(), args.repeat)
+
+    # the journal keeps the cold enrichment from rewriting the whole file for every google search
+    cache = JsonFileCache(cache_file, requests_file, journal=True, compact_records=args.compact_records)
+    google_client = ReplayGoogleClient()
+    places = GooglePlacesLookup(None, cache, download_images=False)
+    places._client = google_client
+    stages['json_write'] = measure(cache._write_cache, args.repeat)
+
+    session = ReplayTIHSession(records, DATASETS)
+    tih_api = TIHAPI("bench", places, "tih_datasets_cache.json", enrichment_workers=args.workers, session=session)
+    # the first enrichment searches google for every record without a cached place, afterwards these locations
+    # are known as already searched
+    enriched = copy.deepcopy(records)
+    stages['_enrich_with_google_data_cold'] = measure(lambda: tih_api._enrich_with_google_data(enriched), 1,
+                                                      len(records))
+    cold_google_calls = dict(google_client.calls)
+
+    locations = [(record['location']['latitude'], record['location']['longitude']) for record in records]
+    stages['get_cache'] = measure(lambda: [cache.get_cache(latitude, longitude) for latitude, longitude in locations],
+                                  args.repeat, len(locations))
+
+    lookups = list[tuple[str, str, str, list[dict]]]()
+    for record, (latitude, longitude) in zip(records, locations):
+        lookups.append((record['name'], record['address']['block'], record['address']['streetName'],
+                        cache.get_cache(latitude, longitude)))
+    stages['_filter_place'] = measure(lambda: [places._filter_place(*lookup) for lookup in lookups], args.repeat,
+                                      len(lookups))
+
+    stages['_enrich_with_google_data'] = measure(tih_api._enrich_with_google_data, args.repeat, len(records),
+                                                 lambda: copy.deepcopy(records))
+
+    start_date = datetime.datetime(2024, 5, 2)
+    end_date = datetime.datetime(2024, 5, 9)
+    stages['multiple_datasets_by_keywords'] = measure(
+        lambda: tih_api.multiple_datasets_by_keywords(["food_beverages", "attractions"], ["local food"], 25,
+                                                      start_date, end_date), args.repeat)
+
+    format_result = load_format_result()
+    matched = [record for record in enriched if 'google_data' in record]
+    stages['format_result'] = measure(lambda: [format_result(record) for record in matched], args.repeat,
+                                      max(len(matched), 1))
+
+    cache.close()
+    return {
+        'cache_size': size,
+        'records': len(records),
+        'matched_records': len(matched),
+        'google_calls_cold': cold_google_calls,
+        'google_calls_total': dict(google_client.calls),
+        'tih_requests': session.request_count,
+        'stages': stages
+    }
+
+
+def benchmark_llm(args) -> dict:
+    llm = OpenAILLMQueries("bench", "gpt-4-turbo")
+    llm._client = ReplayOpenAIClient()
+    return {
+        'collect_user_data': measure(lambda: llm.collect_user_data(CONVERSATION), args.repeat),
+        'select_datasets_and_keywords': measure(lambda: llm.select_datasets_and_keywords(CONVERSATION, DATASETS),
+                                                args.repeat),
+        'get_query_keywords': measure(lambda: llm.get_query_keywords(CONVERSATION), args.repeat),
+        # the /stream endpoint, every piece of text is passed on as it arrives
+        'collect_user_data_streamed': measure(lambda: llm.collect_user_data(CONVERSATION, on_text=len),
+                                              args.repeat),
+        'recommendation_answer_streamed': measure(lambda: llm.collect_user_data(TOOL_CONVERSATION, on_text=len),
+                                                  args.repeat)
+    }
+
+
+def load_format_result():
+    # the services of app read their files from the working directory, it has to be the prepared one
+    import app
+    app.create_app()
+    return app.format_result
+
+
+def get_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_arguments()
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix="tih_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    output_path = os.path.abspath(args.output) if args.output else None
+    progress(f"benchmark files are written to {workdir}")
+    os.chdir(workdir)
+    prepare_workdir(workdir)
+
+    results = {
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'config': {'sizes': args.sizes, 'records': args.records, 'repeat': args.repeat, 'workers': args.workers,
+                   'compact_records': args.compact_records, 'seed': args.seed},
+        'cache_sizes': list(),
+        'llm': dict()
+    }
+    output = None if args.verbose else open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(output if output is not None else sys.stdout):
+            for size in args.sizes:
+                progress(f"cache size {size}...")
+                results['cache_sizes'].append(benchmark_cache_size(size, args))
+            progress("llm queries...")
+            results['llm'] = benchmark_llm(args)
+    finally:
+        if output is not None:
+            output.close()
+
+    json_object = json.dumps(results, indent=4)
+    if output_path is None:
+        print(json_object)
+    else:
+        with open(output_path, "w") as outfile:
+            outfile.write(json_object)
+        progress(f"results written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
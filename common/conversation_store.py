@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import json
+import sqlite3
+import threading
+import time
+
+
+@dataclass
+class Conversation:
+    ai_conversation: list[dict] = field(default_factory=list)
+    view_conversation: list[dict] = field(default_factory=list)
+
+
+class IConversationStore:
+    def load(self, session_id: str) -> Conversation:
+        pass
+
+    def save(self, session_id: str, conversation: Conversation):
+        pass
+
+    def delete(self, session_id: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class InMemoryConversationStore(IConversationStore):
+    """Keeps the conversations of the max_sessions most recently active sessions in memory.
+    Only usable with a single process, conversations are dropped after idle_timeout seconds without activity."""
+
+    def __init__(self, max_sessions: int = 1000, idle_timeout: float = 3600):
+        self._max_sessions = max_sessions
+        self._idle_timeout = idle_timeout
+        self._sessions = OrderedDict[str, tuple[float, Conversation]]()
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> Conversation:
+        with self._lock:
+            self._expire()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return Conversation()
+
+            self._sessions[session_id] = (time.time(), entry[1])
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def save(self, session_id: str, conversation: Conversation):
+        with self._lock:
+            self._sessions[session_id] = (time.time(), conversation)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _expire(self):
+        expired_before = time.time() - self._idle_timeout
+        # the least recently used sessions are at the front
+        while len(self._sessions) > 0:
+            session_id, (last_active, _) = next(iter(self._sessions.items()))
+            if last_active >= expired_before:
+                return
+            del self._sessions[session_id]
+
+
+class SqliteConversationStore(IConversationStore):
+    """Stores the conversations in a sqlite database which can be shared by several worker processes"""
+
+    def __init__(self, db_path: str, max_sessions: int = 10000, idle_timeout: float = 3600,
+                 expire_every: int = 100):
+        self._db_path = db_path
+        self._max_sessions = max_sessions
+        self._idle_timeout = idle_timeout
+        self._expire_every = expire_every
+        self._saves_since_expiry = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS conversations (
+                                            session_id TEXT PRIMARY KEY,
+                                            updated_at REAL NOT NULL,
+                                            data TEXT NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+
+    def load(self, session_id: str) -> Conversation:
+        with self._lock:
+            row = self._connection.execute("SELECT updated_at, data FROM conversations WHERE session_id = ?",
+                                           (session_id,)).fetchone()
+
+        if row is None or row[0] < time.time() - self._idle_timeout:
+            return Conversation()
+
+        data = json.loads(row[1])
+        return Conversation(data['ai_conversation'], data['view_conversation'])
+
+    def save(self, session_id: str, conversation: Conversation):
+        data = json.dumps({'ai_conversation': conversation.ai_conversation,
+                           'view_conversation': conversation.view_conversation})
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO conversations (session_id, updated_at, data) "
+                                     "VALUES (?, ?, ?)", (session_id, time.time(), data))
+            self._saves_since_expiry = self._saves_since_expiry + 1
+            if self._saves_since_expiry >= self._expire_every:
+                self._saves_since_expiry = 0
+                self._expire()
+
+    def delete(self, session_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _expire(self):
+        self._connection.execute("DELETE FROM conversations WHERE updated_at < ?",
+                                 (time.time() - self._idle_timeout,))
+        # keep only the most recently active sessions
+        self._connection.execute("""DELETE FROM conversations WHERE session_id NOT IN (
+                                        SELECT session_id FROM conversations ORDER BY updated_at DESC LIMIT ?)""",
+                                 (self._max_sessions,))
@@ -0,0 +1,140 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# seconds, from a cached lookup up to a slow llm request
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...]):
+        self.name = name
+        self._description = description
+        self._label_names = label_names
+        self._lock = threading.Lock()
+
+    def _get_label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if len(labels) != len(self._label_names):
+            raise ValueError(f"{self.name} expects the labels {self._label_names}, got {tuple(labels)}")
+        return tuple(str(labels[label_name]) for label_name in self._label_names)
+
+    def _format_labels(self, label_values: tuple[str, ...], extra: str = "") -> str:
+        parts = [f'{label_name}="{self._escape(value)}"' for label_name, value in zip(self._label_names,
+                                                                                        label_values)]
+        if len(extra) > 0:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+    def _escape(self, value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def _render_header(self, metric_type: str) -> list[str]:
+        return [f"# HELP {self.name} {self._description}", f"# TYPE {self.name} {metric_type}"]
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, description, label_names)
+        self._values = dict[tuple[str, ...], float]()
+
+    def inc(self, amount: float = 1, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+
+        lines = self._render_header("counter")
+        for label_values, value in values:
+            lines.append(f"{self.name}{self._format_labels(label_values)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self._buckets = tuple(sorted(buckets))
+        # per label values: observations per bucket, the last one is +Inf, and the sum of all observations
+        self._values = dict[tuple[str, ...], tuple[list[int], list[float]]]()
+
+    def observe(self, value: float, **labels):
+        label_values = self._get_label_values(labels)
+        # the bucket index is found before taking the lock, recording stays a few dict and list updates
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = ([0] * (len(self._buckets) + 1), [0.0])
+                self._values[label_values] = entry
+            entry[0][index] = entry[0][index] + 1
+            entry[1][0] = entry[1][0] + value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the with block, also if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = [(label_values, list(counts), total[0]) for label_values, (counts, total) in self._values.items()]
+
+        lines = self._render_header("histogram")
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bucket, count in zip(self._buckets, counts):
+                cumulative = cumulative + count
+                bucket_labels = self._format_labels(label_values, f'le="{bucket}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative = cumulative + counts[-1]
+            bucket_labels = self._format_labels(label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(label_values)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(label_values)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collects the metrics of a process and renders them in the prometheus text format.
+    Every worker process has its own registry, a scraper has to reach each of them."""
+
+    def __init__(self):
+        self._metrics = dict[str, _Metric]()
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = list[str]()
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: _Metric):
+        with self._lock:
+            # modules may be imported more than once, e.g. by a reloader
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"metric {metric.name} is already registered as {type(existing).__name__}")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+
+REGISTRY = MetricsRegistry()
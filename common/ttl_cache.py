@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+
+
+class TTLCache:
+    """Thread safe LRU cache whose entries expire after ttl seconds.
+
+    Keys must be strings and values json serialisable if the cache is persisted to file_path.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, file_path: str = ""):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._file_path = file_path
+        self._entries = OrderedDict[str, tuple[float, any]]()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if len(file_path) > 0 and os.path.exists(file_path):
+            self._load()
+
+    def get(self, key: str, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses = self._misses + 1
+                return default
+
+            self._entries.move_to_end(key)
+            self._hits = self._hits + 1
+            return entry[1]
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._evictions = self._evictions + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'size': len(self._entries)
+            }
+
+    def save(self):
+        if len(self._file_path) == 0:
+            return
+
+        now = time.time()
+        with self._lock:
+            entries = [[key, expires_at, value] for key, (expires_at, value) in self._entries.items()
+                       if expires_at > now]
+
+        json_object = json.dumps({'entries': entries})
+        temp_file_path = f"{self._file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w") as outfile:
+            outfile.write(json_object)
+        os.replace(temp_file_path, self._file_path)
+
+    def close(self):
+        self.save()
+
+    def _load(self):
+        now = time.time()
+        with open(self._file_path, "r") as file:
+            json_obj = json.load(file)
+
+        with self._lock:
+            # entries are saved from least to most recently used
+            for key, expires_at, value in json_obj.get('entries', list()):
+                if expires_at > now:
+                    self._entries[key] = (expires_at, value)
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+        print(f"{len(self._entries)} entries loaded from {self._file_path}")
@@ -5,6 +5,9 @@ class ICache:
     def get_cache(self, latitude: float, longitude: float) -> list[dict]:
         pass
 
+    def get_place(self, place_id: str) -> dict | None:
+        pass
+
     def write_to_cache(self, results: list[dict]):
         pass
 
@@ -16,3 +19,6 @@ class ICache:
 
     def get_all(self) -> list[dict]:
         pass
+
+    def close(self):
+        pass
@@ -0,0 +1,103 @@
+import json
+import os
+import queue
+import threading
+from typing import Callable
+
+
+class CacheJournal:
+    """Append-only journal of changed cache entries.
+
+    Entries are appended as one json object per line by a background thread, so the caller only pays for
+    serialising the changed entries. After compact_after appended entries the compact callback is invoked on the
+    writer thread, which is expected to rewrite the full cache file, after which the journal is truncated.
+    """
+
+    def __init__(self, file_path: str, compact: Callable[[], None], compact_after: int = 500):
+        self._file_path = file_path
+        self._compact = compact
+        self._compact_after = compact_after
+        self._entries_since_compaction = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._closed = False
+
+    def replay(self) -> list[dict]:
+        """Reads all entries of the journal. A partially written last line, e.g. after a crash, is ignored."""
+        entries = list[dict]()
+        if not os.path.exists(self._file_path):
+            return entries
+
+        with open(self._file_path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"skipped corrupt journal entry in {self._file_path}")
+
+        self._entries_since_compaction = len(entries)
+        return entries
+
+    def append(self, entries: list[dict]):
+        if self._closed:
+            raise RuntimeError("cache journal is closed")
+
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        self._ensure_writer()
+        self._queue.put((lines, len(entries)))
+
+    def request_compaction(self):
+        self._ensure_writer()
+        self._queue.put(None)
+
+    def close(self):
+        """Writes all pending entries and stops the writer thread."""
+        if self._closed:
+            return
+
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(StopIteration)
+            self._thread.join()
+
+    def _ensure_writer(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cache-journal-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is StopIteration:
+                return
+
+            if item is None:
+                self._run_compaction()
+                continue
+
+            lines, count = item
+            with open(self._file_path, "a") as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+            self._entries_since_compaction = self._entries_since_compaction + count
+            if self._entries_since_compaction >= self._compact_after:
+                self._run_compaction()
+
+    def _run_compaction(self):
+        try:
+            self._compact()
+        except Exception as e:
+            # keep the journal, the entries are replayed on the next start
+            print(f"cache compaction failed: {e}")
+            return
+
+        # Everything queued before this point is already written, entries still in the queue land in the new
+        # journal. Some of them may also be part of the compacted file, replaying them again is harmless.
+        open(self._file_path, "w").close()
+        self._entries_since_compaction = 0
+        print("cache journal compacted")
@@ -1,18 +1,54 @@
 from enrich_places_api.cache_interface import ICache
+from enrich_places_api.cache_journal import CacheJournal
+from enrich_places_api.place_record import PlaceRecord
+from enrich_places_api.cache_snapshot import get_file_stamp, read_snapshot, write_snapshot
+from enrich_places_api.spatial_index import GridSpatialIndex, get_distance_km
 import json
 import hashlib
-from math import radians, cos, sin, asin, sqrt
 from datetime import datetime
 import os
+import threading
+
+
+def _atomic_write(file_path: str, content: str):
+    # write to a temporary file first so a crash never leaves a half written file behind.
+    # The process and thread id keep concurrent writers, also forked workers, from sharing a temporary file.
+    temp_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file_path, "w") as outfile:
+        outfile.write(content)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_file_path, file_path)
 
 
 class JsonFileCache(ICache):
-    def __init__(self, file_path: str, file_path_cache_requests: str = ""):
+    def __init__(self, file_path: str, file_path_cache_requests: str = "", journal: bool = False,
+                 compact_after: int = 500, request_flush_size: int = 25, request_flush_interval: float = 5.0,
+                 compact_records: bool = False, snapshot_path: str = ""):
         self._file_path = file_path
         self._file_path_cache_requests = file_path_cache_requests
+        # binary copy of the json files which loads faster, rewritten whenever it doesn't match them anymore
+        self._snapshot_path = snapshot_path
         self._cache = list[dict]()
         self._cache_set = dict()
         self._cache_requests = set()
+        self._search_radius_km = 1
+        self._spatial_index = GridSpatialIndex(self._search_radius_km)
+        # with compact records only the fields used for matching and rendering are kept, see PlaceRecord.
+        # The dropped raw google data is also missing from the file once it is written again.
+        self._compact_records = compact_records
+        # guards the cached data against concurrent lookups and the journal writer thread
+        self._lock = threading.RLock()
+        self._journal = None
+        if journal:
+            self._journal = CacheJournal(f"{file_path}.journal", self._write_cache, compact_after)
+
+        # new request hashes are buffered and written in batches, see _add_cache_request
+        self._requests_lock = threading.Lock()
+        self._request_flush_size = request_flush_size
+        self._request_flush_interval = request_flush_interval
+        self._pending_request_count = 0
+        self._request_flush_timer = None
         if not os.path.exists(file_path):
             with open(file_path, 'w') as file:
                 file.write("{}")
@@ -27,83 +63,202 @@ class JsonFileCache(ICache):
     def get_cache(self, latitude: float, longitude: float) -> list[dict]:
         self._is_request_in_cache(latitude, longitude, True)
         relevant_places = list[dict]()
-        for place in self._cache:
-            if self._get_distance(latitude, longitude, float(place['geometry']['location']['lat']),
-                                  float(place['geometry']['location']['lng'])) < 1:
-                relevant_places.append(place)
+        with self._lock:
+            # sorted to keep the cache order, the first match found by the places filter wins
+            for index in sorted(self._spatial_index.query(latitude, longitude, self._search_radius_km)):
+                place = self._cache[index]
+                place_latitude, place_longitude = self._get_location(place)
+                if self._get_distance(latitude, longitude, place_latitude, place_longitude) < self._search_radius_km:
+                    relevant_places.append(place)
 
         # print(f"{len(relevant_places)} relevant items retrieved from cache.")
         return relevant_places
 
+    def get_place(self, place_id: str) -> dict | None:
+        with self._lock:
+            index = self._cache_set.get(place_id)
+            return self._cache[index] if index is not None else None
+
     def write_to_cache(self, results: list[dict]):
         added = 0
-        for result in results:
-            result['cachedAt'] = datetime.today().strftime("%d-%m-%y %H:%M:%S")
-            if result['reference'] not in self._cache_set:
-                self._cache.append(result)
-                self._cache_set[result['reference']] = len(self._cache) - 1
-                added = added + 1
-            else:
-                cache_index = self._cache_set[result['reference']]
-                self._cache[cache_index] = result
-
-        for item in self._cache:
-            item['cachedAt'] = datetime.today().strftime("%d-%m-%y %H:%M:%S")
+        cached_at = datetime.today().strftime("%d-%m-%y %H:%M:%S")
+        with self._lock:
+            for result in results:
+                # only new or updated entries are stamped
+                result['cachedAt'] = cached_at
+                if self._upsert(result):
+                    added = added + 1
 
         print(f"write to cache: total items={len(self._cache)}, added={added}, updated={len(results)-added}")
-        self._write_cache()
+        self._persist(results)
 
     def write_place_details(self, place_id: str, data: dict):
-        index = self._cache_set[place_id]
-        self._cache[index]['details_request_data'] = data
+        with self._lock:
+            index = self._cache_set[place_id]
+            if self._compact_records:
+                # the details are not kept, only a missing photo reference is taken from them
+                place = self._cache[index].to_dict()
+                if 'photos' not in place and len(data.get('photos', list())) > 0:
+                    place['photos'] = data['photos'][:1]
+                    self._cache[index] = PlaceRecord.from_dict(place)
+            else:
+                self._cache[index]['details_request_data'] = data
+                place = self._cache[index]
+
         print(f"Cached place details.")
-        self._write_cache()
+        self._persist([place])
 
     def load_cache(self):
-        with open(self._file_path, "r") as file:
-            json_obj = json.load(file)
-            if 'cache_data' in json_obj:
-                self._cache = json_obj['cache_data']
-                self._cache_set = dict()
-                index = 0
-                for item in self._cache:
-                    self._cache_set[item['reference']] = index
-                    index = index + 1
+        snapshot = None
+        if len(self._snapshot_path) > 0:
+            snapshot = read_snapshot(self._snapshot_path, get_file_stamp(self._file_path),
+                                     get_file_stamp(self._file_path_cache_requests))
 
-            if 'cache_requests' in json_obj:
-                self._cache_requests = set(json_obj['cache_requests'])
+        if snapshot is not None:
+            self._set_cache_data(snapshot[0], snapshot[2])
+            self._cache_requests = snapshot[1]
+            print(f"cache loaded from snapshot: {len(self._cache)}, cache requests: {len(self._cache_requests)}")
+        else:
+            with open(self._file_path, "r") as file:
+                json_obj = json.load(file)
+                if 'cache_data' in json_obj:
+                    self._set_cache_data(json_obj.pop('cache_data'))
+
+                if 'cache_requests' in json_obj:
+                    self._cache_requests = set(json_obj['cache_requests'])
 
-            print(f"cache loaded: {len(self._cache)}")
+                print(f"cache loaded: {len(self._cache)}")
 
-        self._load_cache_requests()
+            self._load_cache_requests()
+            if len(self._snapshot_path) > 0:
+                self._write_snapshot()
+
+        if self._journal is not None:
+            entries = self._journal.replay()
+            with self._lock:
+                for entry in entries:
+                    self._upsert(entry)
+            print(f"cache journal replayed: {len(entries)} entries")
 
     def get_all(self) -> list[dict]:
-        return self._cache
+        with self._lock:
+            return list(self._cache)
+
+    def close(self):
+        self._flush_cache_requests()
+        if self._journal is not None:
+            self._journal.request_compaction()
+            self._journal.close()
+        if len(self._snapshot_path) > 0:
+            self._write_snapshot()
+
+    def _set_cache_data(self, cache_data: list[dict], index_state: tuple | None = None):
+        self._cache = cache_data
+        if self._compact_records:
+            self._cache = [PlaceRecord.from_dict(item) for item in cache_data]
+
+        # the lookup structures stored in a snapshot are used as they are
+        if index_state is not None and self._spatial_index.set_state(index_state[1]):
+            self._cache_set = index_state[0]
+            return
+
+        self._cache_set = dict()
+        self._spatial_index.clear()
+        index = 0
+        for item in self._cache:
+            self._cache_set[item['reference']] = index
+            self._index_place(index, item)
+            index = index + 1
+
+    def _write_snapshot(self):
+        # only called while loading and closing, when the json files are not being written
+        with self._lock, self._requests_lock:
+            places = [place.to_dict() for place in self._cache] if self._compact_records else self._cache
+            write_snapshot(self._snapshot_path, places, self._cache_requests,
+                           (self._cache_set, self._spatial_index.get_state()), get_file_stamp(self._file_path),
+                           get_file_stamp(self._file_path_cache_requests))
+
+    def _upsert(self, place: dict) -> bool:
+        if self._compact_records:
+            place = PlaceRecord.from_dict(place)
+
+        if place['reference'] not in self._cache_set:
+            self._cache.append(place)
+            self._cache_set[place['reference']] = len(self._cache) - 1
+            self._index_place(len(self._cache) - 1, place)
+            return True
+
+        cache_index = self._cache_set[place['reference']]
+        self._cache[cache_index] = place
+        self._index_place(cache_index, place)
+        return False
+
+    def _persist(self, changed_places: list[dict]):
+        if self._journal is None:
+            self._write_cache()
+            return
+
+        with self._lock:
+            self._journal.append(changed_places)
 
     def _write_cache(self):
-        cache_obj = {'cache_data': self._cache}
-        json_object = json.dumps(cache_obj, indent=4)
-        with open(self._file_path, "w") as outfile:
-            outfile.write(json_object)
+        with self._lock:
+            if self._compact_records:
+                cache_obj = {'cache_data': [place.to_dict() for place in self._cache]}
+            else:
+                cache_obj = {'cache_data': self._cache}
+            json_object = json.dumps(cache_obj, indent=4)
 
-    def _get_distance(self, lat1: float, lng1: float, lat2: float, lng2: float) -> float:
-        lng1, lat1, lng2, lat2 = map(radians, [lng1, lat1, lng2, lat2])
+        _atomic_write(self._file_path, json_object)
+
+    def _index_place(self, index: int, place: dict):
+        latitude, longitude = self._get_location(place)
+        self._spatial_index.insert(index, latitude, longitude)
 
-        diff_lng = lng2 - lng1
-        diff_lat = lat2 - lat1
-        a = sin(diff_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(diff_lng / 2) ** 2
-        c = 2 * asin(sqrt(a))
-        return c * 6372
+    def _get_location(self, place: dict | PlaceRecord) -> tuple[float, float]:
+        if self._compact_records:
+            return place.lat, place.lng
+        location = place['geometry']['location']
+        return float(location['lat']), float(location['lng'])
+
+    def _get_distance(self, lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+        return get_distance_km(lat1, lng1, lat2, lng2)
 
     def _write_cache_requests(self):
         if len(self._file_path_cache_requests) == 0:
             return
 
-        cache_obj = {'cache_requests': list(self._cache_requests)}
+        with self._requests_lock:
+            cache_obj = {'cache_requests': list(self._cache_requests)}
+
         json_object = json.dumps(cache_obj, indent=4)
         # print(f"write to cache requests: total items={len(self._cache_requests)}")
-        with open(self._file_path_cache_requests, "w") as outfile:
-            outfile.write(json_object)
+        _atomic_write(self._file_path_cache_requests, json_object)
+
+    def _add_cache_request(self, request_hash: str):
+        with self._requests_lock:
+            self._cache_requests.add(request_hash)
+            self._pending_request_count = self._pending_request_count + 1
+            flush_now = self._pending_request_count >= self._request_flush_size
+            if not flush_now and self._request_flush_timer is None:
+                self._request_flush_timer = threading.Timer(self._request_flush_interval, self._flush_cache_requests)
+                self._request_flush_timer.daemon = True
+                self._request_flush_timer.start()
+
+        if flush_now:
+            self._flush_cache_requests()
+
+    def _flush_cache_requests(self):
+        with self._requests_lock:
+            if self._request_flush_timer is not None:
+                self._request_flush_timer.cancel()
+                self._request_flush_timer = None
+
+            if self._pending_request_count == 0:
+                return
+            self._pending_request_count = 0
+
+        self._write_cache_requests()
 
     def _load_cache_requests(self):
         if len(self._file_path_cache_requests) == 0:
@@ -125,8 +280,7 @@ class JsonFileCache(ICache):
         request_hash = self._create_request_hash(latitude, longitude)
         if request_hash not in self._cache_requests:
             if add_if_not:
-                self._cache_requests.add(request_hash)
-                self._write_cache_requests()
+                self._add_cache_request(request_hash)
             return False
 
         return True
@@ -0,0 +1,167 @@
+from enrich_places_api.cache_interface import ICache
+from enrich_places_api.places_lookup_google import GooglePlacesLookup
+from enrich_places_api.place_resolution_store import IPlaceResolutionStore
+from datetime import datetime, timedelta
+import googlemaps
+import threading
+import time
+
+
+class ApiBudget:
+    """Token bucket limiting the google api calls made per hour"""
+
+    def __init__(self, calls_per_hour: int):
+        self._calls_per_hour = calls_per_hour
+        self._tokens = float(calls_per_hour)
+        self._last_refill = time.monotonic()
+
+    def try_acquire(self, calls: int = 1) -> bool:
+        now = time.monotonic()
+        self._tokens = min(float(self._calls_per_hour),
+                           self._tokens + (now - self._last_refill) * self._calls_per_hour / 3600)
+        self._last_refill = now
+        if self._tokens < calls:
+            return False
+
+        self._tokens = self._tokens - calls
+        return True
+
+
+class CacheRefreshScheduler:
+    """Re-validates stale cached places and expired negative lookups on a background thread.
+
+    Places whose cachedAt is older than place_max_age are refreshed with a place details request. TIH records
+    without a google match whose resolution is older than negative_max_age are searched on google again.
+    Both are done oldest first and only as long as the hourly api budget allows.
+
+    With a lock path only the process holding the lock on that file refreshes, so several worker processes
+    neither multiply the budget nor refresh the same places. Another one takes over when the holder exits.
+    """
+
+    # a text search can take up to 3 pages
+    _SEARCH_COST = 3
+
+    def __init__(self, places: GooglePlacesLookup, cache: ICache, resolutions: IPlaceResolutionStore | None = None,
+                 api_calls_per_hour: int = 100, place_max_age: timedelta = timedelta(days=30),
+                 negative_max_age: timedelta = timedelta(days=7), interval: float = 300, lock_path: str = ""):
+        self._places = places
+        self._cache = cache
+        self._resolutions = resolutions
+        self._budget = ApiBudget(api_calls_per_hour)
+        self._place_max_age = place_max_age
+        self._negative_max_age = negative_max_age
+        self._interval = interval
+        self._lock_path = lock_path
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cache-refresh", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._lock_file is not None:
+            # closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def run_once(self) -> tuple[int, int]:
+        """Runs a single refresh cycle
+
+        Returns:
+            tuple[int, int]: the number of refreshed places and re-validated negative lookups
+        """
+        refreshed_places = self._refresh_stale_places()
+        revalidated_lookups = self._revalidate_negative_lookups()
+        if refreshed_places > 0 or revalidated_lookups > 0:
+            print(f"cache refresh: {refreshed_places} places refreshed, "
+                  f"{revalidated_lookups} negative lookups re-validated")
+        return refreshed_places, revalidated_lookups
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                if self._acquire_lock():
+                    self.run_once()
+            except Exception as e:
+                print(f"cache refresh failed: {e}")
+
+    def _acquire_lock(self) -> bool:
+        if len(self._lock_path) == 0 or self._lock_file is not None:
+            return True
+
+        # only used with several gunicorn workers, fcntl is not available on windows
+        import fcntl
+        lock_file = open(self._lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._lock_file = lock_file
+        return True
+
+    def _refresh_stale_places(self) -> int:
+        stale_before = datetime.today() - self._place_max_age
+        stale_places = list[tuple[datetime, dict]]()
+        for place in self._cache.get_all():
+            cached_at = self._parse_timestamp(place.get('cachedAt'))
+            if cached_at < stale_before:
+                stale_places.append((cached_at, place))
+
+        refreshed = 0
+        for _, place in sorted(stale_places, key=lambda entry: entry[0]):
+            if self._stop.is_set() or not self._budget.try_acquire():
+                break
+            self._places.refresh_place(place)
+            refreshed = refreshed + 1
+
+        return refreshed
+
+    def _revalidate_negative_lookups(self) -> int:
+        if self._resolutions is None:
+            return 0
+
+        expired_before = datetime.today() - self._negative_max_age
+        expired_lookups = list[tuple[datetime, dict]]()
+        for resolution in self._resolutions.get_all():
+            if resolution['place_id'] is not None or resolution.get('inputs') is None:
+                continue
+            resolved_at = self._parse_timestamp(resolution.get('resolvedAt'))
+            if resolved_at < expired_before:
+                expired_lookups.append((resolved_at, resolution))
+
+        revalidated = 0
+        for _, resolution in sorted(expired_lookups, key=lambda entry: entry[0]):
+            if self._stop.is_set() or not self._budget.try_acquire(self._SEARCH_COST):
+                break
+
+            inputs = resolution['inputs']
+            try:
+                found_place = self._places.search_again(inputs['name'], inputs['block'], inputs['streetName'],
+                                                        inputs['latitude'], inputs['longitude'])
+            except (googlemaps.exceptions.ApiError, googlemaps.exceptions.TransportError,
+                    googlemaps.exceptions.Timeout) as e:
+                # the lookup stays expired and is searched again in a later cycle
+                print(f"re-validating {resolution['uuid']} failed: {e}")
+                continue
+            place_id = found_place['place_id'] if found_place is not None else None
+            self._resolutions.put(resolution['uuid'], resolution['fingerprint'], place_id, inputs, refresh=True)
+            revalidated = revalidated + 1
+
+        return revalidated
+
+    def _parse_timestamp(self, timestamp: str | None) -> datetime:
+        # entries without a valid timestamp are treated as the oldest
+        if timestamp is None:
+            return datetime.min
+        try:
+            return datetime.strptime(timestamp, "%d-%m-%y %H:%M:%S")
+        except ValueError:
+            return datetime.min
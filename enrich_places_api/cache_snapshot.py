@@ -0,0 +1,74 @@
+import gc
+import marshal
+import os
+import struct
+
+# magic, format version and the size and modification time of the places and request json files the
+# snapshot was taken from
+_HEADER = struct.Struct("<8sHqqqq")
+_MAGIC = b"TIHCACHE"
+SNAPSHOT_VERSION = 1
+
+
+def get_file_stamp(file_path: str) -> tuple[int, int]:
+    if len(file_path) == 0 or not os.path.exists(file_path):
+        return 0, 0
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def write_snapshot(file_path: str, places: list[dict], request_hashes: set[str], index,
+                   places_stamp: tuple[int, int], requests_stamp: tuple[int, int]):
+    """Writes the places and request hashes as a binary snapshot of the json cache files with the given stamps.
+    index can be any lookup structure built from the places made of builtin types, so it doesn't have to be
+    rebuilt. The json files stay the source of truth, the snapshot only speeds up loading them."""
+    # request hashes are sha1 hex digests, stored as one block of 20 bytes each
+    hashes = bytes.fromhex("".join(request_hashes))
+    header = _HEADER.pack(_MAGIC, SNAPSHOT_VERSION, *places_stamp, *requests_stamp)
+    payload = marshal.dumps((places, hashes, index))
+
+    # every worker process writes the snapshot on exit
+    temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, "wb") as outfile:
+        outfile.write(header)
+        outfile.write(payload)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_file_path, file_path)
+
+
+def read_snapshot(file_path: str, places_stamp: tuple[int, int],
+                  requests_stamp: tuple[int, int]) -> tuple[list[dict], set[str], object] | None:
+    """Returns the places, request hashes and index of the snapshot. None if there is no snapshot, it has
+    another version or the json files changed since it was taken."""
+    if len(file_path) == 0 or not os.path.exists(file_path):
+        return None
+
+    with open(file_path, "rb") as file:
+        data = file.read()
+
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, *stamps = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != SNAPSHOT_VERSION:
+        print(f"ignoring cache snapshot {file_path} with version {version}")
+        return None
+    if tuple(stamps[:2]) != places_stamp or tuple(stamps[2:]) != requests_stamp:
+        print(f"cache snapshot {file_path} is outdated")
+        return None
+
+    # the decoded objects only contain builtin types without cycles, collecting while decoding would
+    # scan the growing object graph over and over
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        places, hashes, index = marshal.loads(memoryview(data)[_HEADER.size:])
+    except (EOFError, ValueError, TypeError) as e:
+        print(f"cache snapshot {file_path} is corrupt: {e}")
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    hex_hashes = hashes.hex()
+    return places, {hex_hashes[offset:offset + 40] for offset in range(0, len(hex_hashes), 40)}, index
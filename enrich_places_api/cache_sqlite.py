@@ -0,0 +1,194 @@
+from enrich_places_api.cache_interface import ICache
+from enrich_places_api.spatial_index import EARTH_RADIUS_KM, get_distance_km
+import sqlite3
+import json
+import hashlib
+from math import radians, cos, pi
+from datetime import datetime
+import os
+import threading
+
+
+class SqliteCache(ICache):
+    """Places cache stored in a sqlite database.
+
+    Places are kept on disk and updated row by row. The radius lookup uses an R-tree over the place locations,
+    references, place ids and the searched request hashes are indexed.
+    """
+
+    # the same earth radius as the distance check, otherwise the box would be smaller than the search radius
+    _KM_PER_DEGREE_LAT = EARTH_RADIUS_KM * pi / 180
+
+    def __init__(self, db_path: str, import_file_path: str = "", import_file_path_cache_requests: str = ""):
+        self._db_path = db_path
+        self._import_file_path = import_file_path
+        self._import_file_path_cache_requests = import_file_path_cache_requests
+        self._search_radius_km = 1
+        self._lock = threading.RLock()
+        self._connection = None
+
+    def is_request_in_cache(self, latitude: float, longitude: float) -> bool:
+        return self._is_request_in_cache(latitude, longitude, False)
+
+    def get_cache(self, latitude: float, longitude: float) -> list[dict]:
+        self._is_request_in_cache(latitude, longitude, True)
+        # padded slightly against rounding, the distance check removes the places in the corners of the box
+        lat_delta = 1.01 * self._search_radius_km / self._KM_PER_DEGREE_LAT
+        # a degree of longitude is shortest at the edge of the box furthest from the equator
+        edge_latitude = min(abs(latitude) + lat_delta, 90)
+        lng_delta = lat_delta / max(cos(radians(edge_latitude)), 0.01)
+        with self._lock:
+            rows = self._connection.execute(
+                """SELECT places.data, places.latitude, places.longitude
+                   FROM places_rtree JOIN places ON places.id = places_rtree.id
+                   WHERE places_rtree.min_lat <= ? AND places_rtree.max_lat >= ?
+                     AND places_rtree.min_lng <= ? AND places_rtree.max_lng >= ?
+                   ORDER BY places.id""",
+                (latitude + lat_delta, latitude - lat_delta, longitude + lng_delta, longitude - lng_delta)).fetchall()
+
+        relevant_places = list[dict]()
+        for data, place_lat, place_lng in rows:
+            if get_distance_km(latitude, longitude, place_lat, place_lng) < self._search_radius_km:
+                relevant_places.append(json.loads(data))
+
+        return relevant_places
+
+    def get_place(self, place_id: str) -> dict | None:
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM places WHERE place_id = ?", (place_id,)).fetchone()
+            if row is None:
+                row = self._connection.execute("SELECT data FROM places WHERE reference = ?", (place_id,)).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def write_to_cache(self, results: list[dict]):
+        added = 0
+        cached_at = datetime.today().strftime("%d-%m-%y %H:%M:%S")
+        with self._lock, self._connection:
+            for result in results:
+                result['cachedAt'] = cached_at
+                if self._upsert(result):
+                    added = added + 1
+
+            total = self._connection.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+
+        print(f"write to cache: total items={total}, added={added}, updated={len(results)-added}")
+
+    def write_place_details(self, place_id: str, data: dict):
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT id, data FROM places WHERE place_id = ?", (place_id,)).fetchone()
+            if row is None:
+                row = self._connection.execute("SELECT id, data FROM places WHERE reference = ?",
+                                               (place_id,)).fetchone()
+            if row is None:
+                raise KeyError(place_id)
+
+            place = json.loads(row[1])
+            place['details_request_data'] = data
+            self._connection.execute("UPDATE places SET data = ? WHERE id = ?", (json.dumps(place), row[0]))
+
+        print(f"Cached place details.")
+
+    def load_cache(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self._db_path, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+                self._create_tables()
+
+            place_count = self._connection.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+            request_count = self._connection.execute("SELECT COUNT(*) FROM cache_requests").fetchone()[0]
+
+        if place_count == 0 and request_count == 0:
+            self._import_json()
+        else:
+            print(f"cache loaded: {place_count}")
+            print(f"cache requests loaded: {request_count}")
+
+    def get_all(self) -> list[dict]:
+        with self._lock:
+            rows = self._connection.execute("SELECT data FROM places ORDER BY id").fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _create_tables(self):
+        with self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS places (
+                                            id INTEGER PRIMARY KEY,
+                                            reference TEXT NOT NULL UNIQUE,
+                                            place_id TEXT,
+                                            cached_at TEXT,
+                                            latitude REAL NOT NULL,
+                                            longitude REAL NOT NULL,
+                                            data TEXT NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS places_place_id ON places (place_id)")
+            self._connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS places_rtree
+                                        USING rtree(id, min_lat, max_lat, min_lng, max_lng)""")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS cache_requests (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def _upsert(self, place: dict) -> bool:
+        row = self._connection.execute("SELECT id FROM places WHERE reference = ?", (place['reference'],)).fetchone()
+        data = json.dumps(place)
+        latitude = float(place['geometry']['location']['lat'])
+        longitude = float(place['geometry']['location']['lng'])
+        if row is None:
+            cursor = self._connection.execute(
+                "INSERT INTO places (reference, place_id, cached_at, latitude, longitude, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (place['reference'], place.get('place_id'), place.get('cachedAt'), latitude, longitude, data))
+            place_row_id = cursor.lastrowid
+        else:
+            place_row_id = row[0]
+            self._connection.execute(
+                "UPDATE places SET place_id = ?, cached_at = ?, latitude = ?, longitude = ?, data = ? WHERE id = ?",
+                (place.get('place_id'), place.get('cachedAt'), latitude, longitude, data, place_row_id))
+
+        # the r-tree stores single precision bounds, the exact distance check uses the columns of the places table
+        self._connection.execute("INSERT OR REPLACE INTO places_rtree VALUES (?, ?, ?, ?, ?)",
+                                 (place_row_id, latitude, latitude, longitude, longitude))
+        return row is None
+
+    def _import_json(self):
+        """Imports an existing JsonFileCache so switching the backend doesn't start with an empty cache"""
+        places = list[dict]()
+        if len(self._import_file_path) > 0 and os.path.exists(self._import_file_path):
+            with open(self._import_file_path, "r") as file:
+                places = json.load(file).get('cache_data', list())
+
+        request_hashes = list[str]()
+        if len(self._import_file_path_cache_requests) > 0 and os.path.exists(self._import_file_path_cache_requests):
+            with open(self._import_file_path_cache_requests, "r") as file:
+                request_hashes = json.load(file).get('cache_requests', list())
+
+        with self._lock, self._connection:
+            for place in places:
+                self._upsert(place)
+            self._connection.executemany("INSERT OR IGNORE INTO cache_requests (hash) VALUES (?)",
+                                         [(request_hash,) for request_hash in request_hashes])
+
+        print(f"cache imported: {len(places)}")
+        print(f"cache requests imported: {len(request_hashes)}")
+
+    def _create_request_hash(self, latitude: float, longitude: float):
+        h = hashlib.new('sha1', usedforsecurity=False)
+        h.update(f"{latitude}_{longitude}".encode())
+        return h.hexdigest()
+
+    def _is_request_in_cache(self, latitude: float, longitude: float, add_if_not: bool) -> bool:
+        request_hash = self._create_request_hash(latitude, longitude)
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM cache_requests WHERE hash = ?", (request_hash,)).fetchone()
+            if row is None:
+                if add_if_not:
+                    with self._connection:
+                        self._connection.execute("INSERT OR IGNORE INTO cache_requests (hash) VALUES (?)",
+                                                 (request_hash,))
+                return False
+
+        return True
@@ -0,0 +1,77 @@
+import queue
+import threading
+import time
+from typing import Callable
+
+
+class ImageDownloadQueue:
+    """Downloads place images on background worker threads.
+
+    Jobs are de-duplicated by place id while they are queued or running. A failed download is retried with an
+    exponential backoff before it is dropped, a dropped place id can be queued again later.
+    """
+
+    def __init__(self, download: Callable[[str, str | None], None], workers: int = 2, max_retries: int = 3,
+                 retry_delay: float = 2.0):
+        self._download = download
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._pending = set[str]()
+        self._lock = threading.Lock()
+        self._threads = list[threading.Thread]()
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, name=f"image-download-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, place_id: str, photo_reference: str | None = None) -> bool:
+        """Queues the image of place_id. Without a photo reference the download function has to look it up.
+
+        Returns:
+            bool: False if the place is already queued or being downloaded
+        """
+        with self._lock:
+            if place_id in self._pending:
+                return False
+            self._pending.add(place_id)
+
+        self._queue.put((place_id, photo_reference))
+        return True
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def join(self):
+        """Blocks until all queued images are processed"""
+        self._queue.join()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._process(*job)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, place_id: str, photo_reference: str | None):
+        try:
+            for attempt in range(self._max_retries + 1):
+                try:
+                    self._download(place_id, photo_reference)
+                    return
+                except Exception as e:
+                    if attempt == self._max_retries:
+                        print(f"image download for {place_id} failed: {e}")
+                        return
+                    time.sleep(self._retry_delay * 2 ** attempt)
+        finally:
+            with self._lock:
+                self._pending.discard(place_id)
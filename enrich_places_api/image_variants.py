@@ -0,0 +1,84 @@
+import os
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+
+class ImageVariantStore:
+    """Creates size bounded webp variants of the cached place images.
+
+    Variants are written to <variant_dir>/<variant>/<place_id>.webp the first time they are requested. Without
+    Pillow installed no variants are created and the original image is used instead.
+    """
+
+    VARIANTS = {
+        'card': (480, 360),
+        'detail': (1280, 960)
+    }
+
+    def __init__(self, image_dir: str = "static/image_cache", variant_dir: str = "static/image_cache/variants",
+                 quality: int = 80):
+        self._image_dir = image_dir
+        self._variant_dir = variant_dir
+        self._quality = quality
+        self._lock = threading.Lock()
+        if Image is None:
+            print("Pillow is not installed, original images are served without resizing.")
+
+    def has_image(self, place_id: str) -> bool:
+        return os.path.exists(self._get_image_path(place_id))
+
+    def get_variant_path(self, place_id: str, variant: str) -> str | None:
+        """Returns the path of the requested variant, creating it if needed.
+
+        Returns:
+            str | None: None if the variant is unknown or the original image is not cached
+        """
+        if variant not in self.VARIANTS or not self._is_valid_place_id(place_id):
+            return None
+
+        image_path = self._get_image_path(place_id)
+        if not os.path.exists(image_path):
+            return None
+
+        if Image is None:
+            return image_path
+
+        variant_path = self._get_variant_path(place_id, variant)
+        if not os.path.exists(variant_path):
+            self._create_variant(image_path, variant_path, self.VARIANTS[variant])
+
+        return variant_path
+
+    def create_variants(self, place_id: str):
+        for variant in self.VARIANTS:
+            self.get_variant_path(place_id, variant)
+
+    def _create_variant(self, image_path: str, variant_path: str, size: tuple[int, int]):
+        os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+        # one image is resized at the time, resizing is cpu bound and a burst of requests would only compete
+        with self._lock:
+            if os.path.exists(variant_path):
+                return
+
+            with Image.open(image_path) as image:
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail(size)
+                # the lock only covers this process
+                temp_path = f"{variant_path}.{os.getpid()}.part"
+                image.convert("RGB").save(temp_path, "WEBP", quality=self._quality, method=4)
+            os.replace(temp_path, variant_path)
+
+    def _get_image_path(self, place_id: str) -> str:
+        return os.path.join(self._image_dir, place_id)
+
+    def _get_variant_path(self, place_id: str, variant: str) -> str:
+        return os.path.join(self._variant_dir, variant, f"{place_id}.webp")
+
+    def _is_valid_place_id(self, place_id: str) -> bool:
+        # place ids are used as file names, reject anything that could leave the image directory
+        return len(place_id) > 0 and '/' not in place_id and '\\' not in place_id and not place_id.startswith('.')
@@ -0,0 +1,54 @@
+from collections import Counter
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+
+
+@dataclass(frozen=True, slots=True)
+class PlaceMatchKeys:
+    """Normalised strings used to match a TIH record with a Google place, computed once per place"""
+    name: str
+    name_chars: Counter
+    block: str
+    street: str
+    street_chars: Counter
+    street_abbreviation: str
+
+
+def normalise_street(street_name: str) -> str:
+    # google abbreviate 'road' with 'rd' and 'street' with 'st'. TIH normally doesn't abbreviate these words
+    # while TIH uses 'street' and 'road' normally I do the replacement too just to be sure
+    return street_name.strip().lower().replace(" st", " street").replace(" rd", " road")
+
+
+def create_match_keys(name: str, block: str, street_name: str) -> PlaceMatchKeys:
+    name = name.strip().lower()
+    street = normalise_street(street_name)
+
+    # google abbreviates a lot of with the first characters of each word
+    street_abbreviation = "".join(word[0] for word in street.split(' ') if len(word) > 0)
+    return PlaceMatchKeys(name, Counter(name), block.strip(), street, Counter(street), street_abbreviation)
+
+
+def create_google_match_keys(place: dict) -> PlaceMatchKeys:
+    google_address_parts = place['formatted_address'].split(' ', 1)
+    google_street = google_address_parts[1].split(',')[0] if len(google_address_parts) > 1 else ""
+    return create_match_keys(place['name'], google_address_parts[0], google_street)
+
+
+def is_similar(google_text: str, google_chars: Counter, tih_text: str, tih_chars: Counter, threshold: float) -> bool:
+    """Same as SequenceMatcher(None, google_text, tih_text).ratio() >= threshold.
+    The length and character count bounds are upper bounds of the ratio, they reject most candidates without
+    running the expensive matching.
+    """
+    total_length = len(google_text) + len(tih_text)
+    if total_length == 0:
+        return True
+
+    if 2.0 * min(len(google_text), len(tih_text)) / total_length < threshold:
+        return False
+
+    common_chars = sum((google_chars & tih_chars).values())
+    if 2.0 * common_chars / total_length < threshold:
+        return False
+
+    return SequenceMatcher(None, google_text, tih_text).ratio() >= threshold
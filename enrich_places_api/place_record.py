@@ -0,0 +1,85 @@
+from collections.abc import Mapping
+import sys
+
+
+class PlaceRecord(Mapping):
+    """Compact in memory form of a cached google place. Only the fields used for matching and rendering are kept,
+    the raw google payload such as details_request_data, reviews and viewports is dropped.
+
+    Reading works like with the raw dict, place['geometry']['location']['lat'] and place['photos'][0] are
+    built on access. Records are replaced, never changed in place.
+    """
+    __slots__ = ('reference', 'place_id', 'name', 'formatted_address', 'lat', 'lng', 'rating', 'user_ratings_total',
+                 'business_status', 'photo_reference', 'cached_at')
+
+    # dict key to slot for the plain fields
+    _ATTRIBUTES = {
+        'reference': 'reference',
+        'place_id': 'place_id',
+        'name': 'name',
+        'formatted_address': 'formatted_address',
+        'rating': 'rating',
+        'user_ratings_total': 'user_ratings_total',
+        'business_status': 'business_status',
+        'cachedAt': 'cached_at'
+    }
+
+    def __init__(self, reference: str, place_id: str, name: str, formatted_address: str, lat: float, lng: float,
+                 rating: float | None = None, user_ratings_total: int | None = None,
+                 business_status: str | None = None, photo_reference: str | None = None,
+                 cached_at: str | None = None):
+        self.reference = reference
+        self.place_id = place_id
+        self.name = name
+        self.formatted_address = formatted_address
+        self.lat = lat
+        self.lng = lng
+        self.rating = rating
+        self.user_ratings_total = user_ratings_total
+        # few distinct values, shared instead of one string per place
+        self.business_status = sys.intern(business_status) if business_status is not None else None
+        self.photo_reference = photo_reference
+        self.cached_at = sys.intern(cached_at) if cached_at is not None else None
+
+    @classmethod
+    def from_dict(cls, place: dict) -> 'PlaceRecord':
+        if isinstance(place, PlaceRecord):
+            return place
+
+        location = place['geometry']['location']
+        photos = place.get('photos')
+        photo_reference = photos[0]['photo_reference'] if photos else None
+        return cls(place['reference'], place['place_id'], place['name'], place['formatted_address'],
+                   float(location['lat']), float(location['lng']), place.get('rating'),
+                   place.get('user_ratings_total'), place.get('business_status'), photo_reference,
+                   place.get('cachedAt'))
+
+    def to_dict(self) -> dict:
+        """Returns the record in the google result format, fields which are not set are left out"""
+        return {key: self[key] for key in self}
+
+    def __getitem__(self, key: str):
+        if key == 'geometry':
+            return {'location': {'lat': self.lat, 'lng': self.lng}}
+        if key == 'photos' and self.photo_reference is not None:
+            return [{'photo_reference': self.photo_reference}]
+
+        attribute = self._ATTRIBUTES.get(key)
+        value = getattr(self, attribute) if attribute is not None else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for key, attribute in self._ATTRIBUTES.items():
+            if getattr(self, attribute) is not None:
+                yield key
+        yield 'geometry'
+        if self.photo_reference is not None:
+            yield 'photos'
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"PlaceRecord({self.to_dict()})"
@@ -0,0 +1,206 @@
+from enrich_places_api.cache_journal import CacheJournal
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+
+def _create_fingerprint(name: str, block: str, street_name: str, latitude: float, longitude: float) -> str:
+    h = hashlib.new('sha1', usedforsecurity=False)
+    h.update(f"{name.strip().lower()}_{block.strip()}_{street_name.strip().lower()}_{latitude}_{longitude}".encode())
+    return h.hexdigest()
+
+
+def _create_resolution(uuid: str, fingerprint: str, place_id: str | None, inputs: dict | None) -> dict:
+    return {
+        'uuid': uuid,
+        'fingerprint': fingerprint,
+        'place_id': place_id,
+        'inputs': inputs,
+        'resolvedAt': datetime.today().strftime("%d-%m-%y %H:%M:%S")
+    }
+
+
+class IPlaceResolutionStore:
+    def create_fingerprint(self, name: str, block: str, street_name: str, latitude: float, longitude: float) -> str:
+        pass
+
+    def get(self, uuid: str, fingerprint: str) -> tuple[bool, str | None]:
+        pass
+
+    def put(self, uuid: str, fingerprint: str, place_id: str | None, inputs: dict | None = None,
+            refresh: bool = False):
+        pass
+
+    def remove(self, uuid: str):
+        pass
+
+    def get_all(self) -> list[dict]:
+        pass
+
+    def close(self):
+        pass
+
+
+class PlaceResolutionStore(IPlaceResolutionStore):
+    """Remembers which google place a TIH record resolved to, or that it has no match, keyed by the TIH uuid.
+
+    Every entry keeps a fingerprint of the name, address and location it was resolved with. If the TIH record
+    changes the fingerprint doesn't match anymore and the entry is ignored. Changes are appended to a journal,
+    the json file is rewritten on compaction. Only usable with a single process.
+    """
+
+    def __init__(self, file_path: str, compact_after: int = 500):
+        self._file_path = file_path
+        self._resolutions = dict[str, dict]()
+        self._lock = threading.Lock()
+        self._journal = CacheJournal(f"{file_path}.journal", self._write_resolutions, compact_after)
+        self._load()
+
+    def create_fingerprint(self, name: str, block: str, street_name: str, latitude: float, longitude: float) -> str:
+        return _create_fingerprint(name, block, street_name, latitude, longitude)
+
+    def get(self, uuid: str, fingerprint: str) -> tuple[bool, str | None]:
+        """Returns whether the record is resolved and the place id it resolved to, None for a confirmed non-match"""
+        with self._lock:
+            resolution = self._resolutions.get(uuid)
+
+        if resolution is None or resolution['fingerprint'] != fingerprint:
+            return False, None
+
+        return True, resolution['place_id']
+
+    def put(self, uuid: str, fingerprint: str, place_id: str | None, inputs: dict | None = None,
+            refresh: bool = False):
+        """Stores the resolution, an unchanged resolution is only written again with refresh to update resolvedAt"""
+        resolution = _create_resolution(uuid, fingerprint, place_id, inputs)
+        with self._lock:
+            previous = self._resolutions.get(uuid)
+            if not refresh and previous is not None and previous['fingerprint'] == fingerprint \
+                    and previous['place_id'] == place_id:
+                return
+            self._resolutions[uuid] = resolution
+            self._journal.append([resolution])
+
+    def remove(self, uuid: str):
+        with self._lock:
+            if self._resolutions.pop(uuid, None) is not None:
+                self._journal.append([{'uuid': uuid, 'removed': True}])
+
+    def get_all(self) -> list[dict]:
+        with self._lock:
+            return list(self._resolutions.values())
+
+    def close(self):
+        self._journal.request_compaction()
+        self._journal.close()
+
+    def _load(self):
+        if os.path.exists(self._file_path):
+            with open(self._file_path, "r") as file:
+                for resolution in json.load(file).get('resolutions', list()):
+                    self._resolutions[resolution['uuid']] = resolution
+
+        for entry in self._journal.replay():
+            if entry.get('removed', False):
+                self._resolutions.pop(entry['uuid'], None)
+            else:
+                self._resolutions[entry['uuid']] = entry
+
+        print(f"place resolutions loaded: {len(self._resolutions)}")
+
+    def _write_resolutions(self):
+        with self._lock:
+            json_object = json.dumps({'resolutions': list(self._resolutions.values())})
+
+        temp_file_path = f"{self._file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, "w") as outfile:
+            outfile.write(json_object)
+        os.replace(temp_file_path, self._file_path)
+
+
+class SqlitePlaceResolutionStore(IPlaceResolutionStore):
+    """Stores the resolutions in a sqlite database which can be shared by several worker processes.
+    An empty database is seeded from the json file of PlaceResolutionStore and its journal."""
+
+    def __init__(self, db_path: str, import_file_path: str = ""):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS place_resolutions (
+                                            uuid TEXT PRIMARY KEY,
+                                            fingerprint TEXT NOT NULL,
+                                            place_id TEXT,
+                                            data TEXT NOT NULL)""")
+
+        count = self._connection.execute("SELECT COUNT(*) FROM place_resolutions").fetchone()[0]
+        if count == 0 and len(import_file_path) > 0:
+            self._import_json(import_file_path)
+        else:
+            print(f"place resolutions loaded: {count}")
+
+    def create_fingerprint(self, name: str, block: str, street_name: str, latitude: float, longitude: float) -> str:
+        return _create_fingerprint(name, block, street_name, latitude, longitude)
+
+    def get(self, uuid: str, fingerprint: str) -> tuple[bool, str | None]:
+        with self._lock:
+            row = self._connection.execute("SELECT fingerprint, place_id FROM place_resolutions WHERE uuid = ?",
+                                           (uuid,)).fetchone()
+
+        if row is None or row[0] != fingerprint:
+            return False, None
+
+        return True, row[1]
+
+    def put(self, uuid: str, fingerprint: str, place_id: str | None, inputs: dict | None = None,
+            refresh: bool = False):
+        resolution = _create_resolution(uuid, fingerprint, place_id, inputs)
+        with self._lock, self._connection:
+            if not refresh:
+                previous = self._connection.execute("SELECT fingerprint, place_id FROM place_resolutions "
+                                                    "WHERE uuid = ?", (uuid,)).fetchone()
+                if previous is not None and previous[0] == fingerprint and previous[1] == place_id:
+                    return
+            self._insert(resolution)
+
+    def remove(self, uuid: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM place_resolutions WHERE uuid = ?", (uuid,))
+
+    def get_all(self) -> list[dict]:
+        with self._lock:
+            rows = self._connection.execute("SELECT data FROM place_resolutions").fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _insert(self, resolution: dict):
+        self._connection.execute("INSERT OR REPLACE INTO place_resolutions (uuid, fingerprint, place_id, data) "
+                                 "VALUES (?, ?, ?, ?)", (resolution['uuid'], resolution['fingerprint'],
+                                                         resolution['place_id'], json.dumps(resolution)))
+
+    def _import_json(self, file_path: str):
+        # read only, the journal of the json store is left as it is
+        resolutions = dict[str, dict]()
+        if os.path.exists(file_path):
+            with open(file_path, "r") as file:
+                for resolution in json.load(file).get('resolutions', list()):
+                    resolutions[resolution['uuid']] = resolution
+
+        for entry in CacheJournal(f"{file_path}.journal", lambda: None).replay():
+            if entry.get('removed', False):
+                resolutions.pop(entry['uuid'], None)
+            else:
+                resolutions[entry['uuid']] = entry
+
+        with self._lock, self._connection:
+            for resolution in resolutions.values():
+                self._insert(resolution)
+
+        print(f"place resolutions imported: {len(resolutions)}")
@@ -2,22 +2,49 @@ import googlemaps
 import time
 
 from enrich_places_api.cache_interface import ICache
+from enrich_places_api.image_download_queue import ImageDownloadQueue
+from enrich_places_api.image_variants import ImageVariantStore
 from enrich_places_api.places_lookup_interface import IPlacesLookup
-from difflib import SequenceMatcher
+from enrich_places_api.place_match_keys import (PlaceMatchKeys, create_match_keys, create_google_match_keys,
+                                                 is_similar)
+from common.metrics import REGISTRY
 import os
-import asyncio
+
+_LOOKUPS = REGISTRY.counter("places_lookup_total", "Place lookups by where the result came from", ("result",))
+_GOOGLE_REQUEST_SECONDS = REGISTRY.histogram("google_api_request_seconds", "Duration of google places api requests",
+                                             ("type",))
+_IMAGE_DOWNLOADS = REGISTRY.counter("image_downloads_total", "Finished place image downloads", ("result",))
+_IMAGE_DOWNLOAD_SECONDS = REGISTRY.histogram("image_download_seconds",
+                                             "Duration of downloading a place image including its variants")
 
 
 class GooglePlacesLookup(IPlacesLookup):
-    def __init__(self, api_key, cache: ICache, download_images: bool = True):
+    # fields of a text search result which are replaced with the place details when a place is refreshed
+    _REFRESHED_FIELDS = ('name', 'formatted_address', 'geometry', 'business_status', 'rating', 'user_ratings_total',
+                         'opening_hours', 'photos', 'types')
+
+    def __init__(self, api_key, cache: ICache, download_images: bool = True, image_workers: int = 2,
+                 image_max_size: int = 1600, image_variants: ImageVariantStore | None = None,
+                 load_cache: bool = True):
         self.download_images = download_images
         self._cache = cache
-        self._cache.load_cache()
+        # the cache may already be loaded by the caller
+        if load_cache:
+            self._cache.load_cache()
         if api_key and not api_key.isspace():
             self._client = googlemaps.Client(key=api_key)
         else:
             self._client = None
 
+        # images are downloaded in the background, until they land the ui shows the fallback image
+        self._image_max_size = image_max_size
+        self._image_variants = image_variants
+        # normalised name, block and street of the cached places, see _get_match_keys
+        self._match_keys = dict[tuple[str, str], PlaceMatchKeys]()
+        self._image_queue = None
+        if self.download_images and self._client is not None:
+            self._image_queue = ImageDownloadQueue(self._download_image, image_workers)
+
     def find_place(self, place: str, block: str, street_name: str, latitude: float, longitude: float) -> dict | None:
         already_searched = self._cache.is_request_in_cache(latitude, longitude)
         results = self._cache.get_cache(latitude, longitude)
@@ -25,52 +52,142 @@ class GooglePlacesLookup(IPlacesLookup):
             #print(f"data collected from cache: {results}")
             found_place = self._filter_place(place, block, street_name, results)
             if found_place is not None:
+                _LOOKUPS.inc(result="cache_hit")
                 self._check_for_image(found_place['place_id'])
                 return found_place
 
         if already_searched:
             print(f"{place} not found in cache and was already searched.")
-            #TODO check cache age and invalidate, if to old query google again (code below)
+            # expired misses are searched again in the background, see CacheRefreshScheduler
+            _LOOKUPS.inc(result="already_searched")
             return None
 
         # API Key not set therefore only the data cache is used
         if self._client is None:
+            _LOOKUPS.inc(result="cache_miss")
             return None
 
         print("Data not found in caching retrieving data from google...")
+        results = self._collect_data(place, latitude, longitude)
+        found_place = self._filter_place(place, block, street_name, results)
+        _LOOKUPS.inc(result="google_match" if found_place is not None else "google_no_match")
+        return found_place
+
+    def get_place(self, place_id: str) -> dict | None:
+        """Returns a cached place by its id without any matching"""
+        found_place = self._cache.get_place(place_id)
+        if found_place is not None:
+            self._check_for_image(place_id)
+        return found_place
+
+    def can_search(self) -> bool:
+        return self._client is not None
+
+    def refresh_place(self, place: dict) -> bool:
+        """Requests the place details again and updates the cached place, which also renews its cachedAt"""
+        if self._client is None:
+            return False
+
+        updated_place = dict(place)
+        try:
+            details = self._get_place_details(place['place_id'])['result']
+        except googlemaps.exceptions.ApiError as e:
+            # the entry is still restamped so a place google doesn't know anymore isn't requested every cycle
+            print(f"refreshing {place['place_id']} failed: {e}")
+            self._cache.write_to_cache([updated_place])
+            return False
+        except (googlemaps.exceptions.TransportError, googlemaps.exceptions.Timeout) as e:
+            # a temporary failure, the place stays stale and is tried again in a later cycle
+            print(f"refreshing {place['place_id']} failed: {e}")
+            return False
+
+        for field in self._REFRESHED_FIELDS:
+            if field in details:
+                updated_place[field] = details[field]
+        updated_place['details_request_data'] = details
+        self._cache.write_to_cache([updated_place])
+        # the photo reference was just fetched, the download must not request the details again
+        if 'photos' in details and len(details['photos']) > 0:
+            self._check_for_image(place['place_id'], details['photos'][0]['photo_reference'])
+        return True
+
+    def search_again(self, place: str, block: str, street_name: str, latitude: float,
+                     longitude: float) -> dict | None:
+        """Searches google even if the location was already searched, used to re-validate earlier misses"""
+        if self._client is None:
+            return None
+
         results = self._collect_data(place, latitude, longitude)
         return self._filter_place(place, block, street_name, results)
 
     def _get_place_details(self, place_id):
-        return self._client.place(place_id)
-
-    def _check_for_image(self, place_id):
-        if self.download_images:
-            if not os.path.exists(f"static/image_cache/{place_id}"):
-                details = self._get_place_details(place_id)['result']
-                self._cache.write_place_details(place_id, details)
-                self._collect_images([details])
+        with _GOOGLE_REQUEST_SECONDS.time(type="details"):
+            return self._client.place(place_id)
+
+    def wait_for_images(self):
+        """Blocks until all queued image downloads are finished"""
+        if self._image_queue is not None:
+            self._image_queue.join()
+
+    def close(self):
+        if self._image_queue is not None:
+            self._image_queue.close()
+
+    def _check_for_image(self, place_id: str, photo_reference: str | None = None):
+        if self._image_queue is not None and not os.path.exists(f"static/image_cache/{place_id}"):
+            self._image_queue.enqueue(place_id, photo_reference)
+
+    def _download_image(self, place_id: str, image_reference: str | None):
+        """Runs on the image queue workers. Without an image reference the place details are requested first"""
+        try:
+            with _IMAGE_DOWNLOAD_SECONDS.time():
+                if image_reference is None:
+                    details = self._get_place_details(place_id)['result']
+                    self._cache.write_place_details(place_id, details)
+                    if 'photos' not in details or len(details['photos']) == 0:
+                        print(f"no photo available for {place_id}")
+                        _IMAGE_DOWNLOADS.inc(result="no_photo")
+                        return
+                    image_reference = details['photos'][0]['photo_reference']
+
+                self._cache_image(place_id, image_reference)
+                print(f"photo cached {place_id}")
+                if self._image_variants is not None:
+                    self._image_variants.create_variants(place_id)
+        except Exception:
+            # the download queue retries, every failed attempt is counted
+            _IMAGE_DOWNLOADS.inc(result="failed")
+            raise
+
+        _IMAGE_DOWNLOADS.inc(result="success")
 
     def _cache_image(self, place_id, image_reference):
-        if not os.path.exists(f"static/image_cache/{place_id}"):
-            result = self._client.places_photo(image_reference, 6000, 6000)
-            with open(f"static/image_cache/{place_id}", 'wb') as file:
-                for a in result:
-                    file.write(a)
+        image_path = f"static/image_cache/{place_id}"
+        if not os.path.exists(image_path):
+            with _GOOGLE_REQUEST_SECONDS.time(type="photo"):
+                result = self._client.places_photo(image_reference, self._image_max_size, self._image_max_size)
+                # the image is renamed once complete so a half downloaded file is never served, other worker
+                # processes may download the same image at the same time
+                temp_path = f"{image_path}.{os.getpid()}.part"
+                with open(temp_path, 'wb') as file:
+                    for a in result:
+                        file.write(a)
+            os.replace(temp_path, image_path)
 
     def _filter_place(self, place: str, block: str, street_name: str, results: list[dict]) -> dict | None:
+        tih_keys = create_match_keys(place, block, street_name)
         for result in results:
-            google_address_parts = result['formatted_address'].split(' ', 1)
+            google_keys = self._get_match_keys(result)
 
-            if self._block_filter(block, google_address_parts[0]):
+            if self._block_filter(tih_keys, google_keys):
                 continue
 
-            if self._name_filter(place, result['name']):
+            if self._name_filter(tih_keys, google_keys):
                 continue
 
             # Street names are too different since google uses a lots of abbreviations
             # For example Google abbreviates 'east coast parkway' with 'ecp'
-            if self._street_filter(street_name, google_address_parts[1].split(',')[0]):
+            if self._street_filter(tih_keys, google_keys):
                 continue
 
             #print(f"match found: {result}")
@@ -78,68 +195,62 @@ class GooglePlacesLookup(IPlacesLookup):
 
         return None
 
-    def _name_filter(self, tih_name: str, google_name: str) -> bool:
-        google_name = google_name.strip().lower()
-        tih_name = tih_name.strip().lower()
+    def _get_match_keys(self, result: dict) -> PlaceMatchKeys:
+        # keyed by the matched fields so updated places get new keys
+        memo_key = (result['name'], result['formatted_address'])
+        keys = self._match_keys.get(memo_key)
+        if keys is None:
+            keys = create_google_match_keys(result)
+            self._match_keys[memo_key] = keys
+        return keys
+
+    def _name_filter(self, tih_keys: PlaceMatchKeys, google_keys: PlaceMatchKeys) -> bool:
+        google_name = google_keys.name
+        tih_name = tih_keys.name
 
         # contains check for cases such as the following:
         # google name=the landing point
         # tih name=the landing point, the fullerton bay hotel singapore
         if google_name != tih_name and google_name not in tih_name and tih_name not in google_name:
             # print(f"Names do not match: google name={google_name}, tih name={tih_name}")
-            similarity_name = SequenceMatcher(None, google_name, tih_name).ratio()
-            # print(f"Name similarity ratio: {similarity_name}")
-
             # 0.5 magic ratio I don't if is a good choice or not.
-            if similarity_name < 0.5:
+            if not is_similar(google_name, google_keys.name_chars, tih_name, tih_keys.name_chars, 0.5):
                 return True
 
         return False
 
-    def _street_filter(self, tih_street_name: str, google_street_name: str) -> bool:
-        # google abbreviate 'road' with 'rd' and 'street' with 'st'. TIH normally doesn't abbreviate these words
-        # while TIH uses 'street' and 'road' normally I do the replacement too just to be sure
-        google_street_name = (google_street_name.strip().lower()
-                              .replace(" st", " street").replace(" rd", " road"))
-        tih_street_name = (tih_street_name.strip().lower()
-                           .replace(" st", " street").replace(" rd", " road"))
-
-        # google abbreviates a lot of with the first characters of each word
-        tih_abbreviation = ""
-        for word in tih_street_name.split(' '):
-            if len(word) > 0:
-                tih_abbreviation = tih_abbreviation + word[0]
-
-        if google_street_name != tih_street_name and tih_abbreviation != google_street_name:
-            similarity_street = SequenceMatcher(None, google_street_name, tih_street_name).ratio()
+    def _street_filter(self, tih_keys: PlaceMatchKeys, google_keys: PlaceMatchKeys) -> bool:
+        google_street_name = google_keys.street
+        tih_street_name = tih_keys.street
 
+        if google_street_name != tih_street_name and tih_keys.street_abbreviation != google_street_name:
             # 0.8 magic ratio I don't if is a good choice or not.
-            if similarity_street < 0.65:
+            if not is_similar(google_street_name, google_keys.street_chars, tih_street_name, tih_keys.street_chars,
+                              0.65):
                 # print(f"street name do not match: google={google_street_name}, tih={tih_street_name}")
-                # print(f"street similarity ratio: {similarity_street}")
                 return True
 
         return False
 
-    def _block_filter(self, tih_block: str, google_block: str) -> bool:
-        google_block = google_block.strip()
-        tih_block = tih_block.strip()
-
+    def _block_filter(self, tih_keys: PlaceMatchKeys, google_keys: PlaceMatchKeys) -> bool:
         #ignore filter if we don't have to block data
-        if len(tih_block) == 0:
+        if len(tih_keys.block) == 0:
             return False
 
-        if google_block != tih_block:
-            #print(f"skipped blocks not equal: google block={google_block}, tih block={tih_block}")
+        if google_keys.block != tih_keys.block:
+            #print(f"skipped blocks not equal: google block={google_keys.block}, tih block={tih_keys.block}")
             return True
 
         return False
 
     def _collect_data(self, place: str, latitude: float, longitude: float, next_page=None) -> list[dict]:
-        places_result = self._client.places(query=place, location={'lat': latitude, 'lng': longitude}, radius=1000,
-                                            page_token=next_page)
+        with _GOOGLE_REQUEST_SECONDS.time(type="text_search"):
+            places_result = self._client.places(query=place, location={'lat': latitude, 'lng': longitude},
+                                                radius=1000, page_token=next_page)
         results = places_result['results']
         self._cache.write_to_cache(results)
+        for result in results:
+            self._get_match_keys(result)
 
         if 'next_page_token' in places_result:
             # The token becomes valid after an unspecified delay. 2 seconds seem to work reliable
@@ -147,20 +258,16 @@ class GooglePlacesLookup(IPlacesLookup):
             time.sleep(2)
             results.extend(self._collect_data(place, latitude, longitude, places_result['next_page_token']))
 
-        #asyncio.ensure_future(self._collect_images(results))
         self._collect_images(results)
         return results
 
     def _collect_images(self, results):
-        if self.download_images:
+        if self._image_queue is not None:
             for result in results:
+                if os.path.exists(f"static/image_cache/{result['place_id']}"):
+                    continue
+
                 if 'photos' in result and len(result['photos']) > 0:
-                    self._cache_image(result['place_id'], result['photos'][0]['photo_reference'])
-                    print(f"photo cached {result['place_id']}")
+                    self._image_queue.enqueue(result['place_id'], result['photos'][0]['photo_reference'])
                 else:
                     print(result)
-
-    def _refresh_cache(self):
-        cached_items = self._cache.get_all()
-        for item in cached_items[::100]:
-            self._check_for_image(item['place_id'])
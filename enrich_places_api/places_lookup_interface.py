@@ -2,3 +2,12 @@ class IPlacesLookup:
     def find_place(self, place: str, block: str, street_name: str, latitude: float, longitude: float) -> dict | None:
         pass
 
+    def get_place(self, place_id: str) -> dict | None:
+        pass
+
+    def can_search(self) -> bool:
+        pass
+
+
+    def close(self):
+        pass
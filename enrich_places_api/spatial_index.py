@@ -0,0 +1,97 @@
+from math import radians, cos, sin, asin, sqrt, floor
+
+EARTH_RADIUS_KM = 6372
+
+
+def get_distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    lng1, lat1, lng2, lat2 = map(radians, [lng1, lat1, lng2, lat2])
+
+    diff_lng = lng2 - lng1
+    diff_lat = lat2 - lat1
+    a = sin(diff_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(diff_lng / 2) ** 2
+    c = 2 * asin(sqrt(a))
+    return c * EARTH_RADIUS_KM
+
+
+class GridSpatialIndex:
+    """Buckets cache indices into fixed size lat/lng cells so radius queries only visit nearby cells.
+
+    Cells are sized in degrees of latitude. A degree of longitude shrinks with the cosine of the latitude, so the
+    number of longitude cells visited per query is widened accordingly.
+    """
+
+    _KM_PER_DEGREE_LAT = 111.32
+
+    def __init__(self, cell_size_km: float = 1.0):
+        self._cell_size_deg = cell_size_km / self._KM_PER_DEGREE_LAT
+        self._cells = dict[tuple[int, int], set[int]]()
+        self._item_cells = dict[int, tuple[int, int]]()
+
+    def clear(self):
+        self._cells = dict[tuple[int, int], set[int]]()
+        self._item_cells = dict[int, tuple[int, int]]()
+
+    def __len__(self) -> int:
+        return len(self._item_cells)
+
+    def get_state(self) -> tuple:
+        """Returns the cells as plain builtin types, used to store the index together with the cache"""
+        return self._cell_size_deg, self._cells, self._item_cells
+
+    def set_state(self, state: tuple) -> bool:
+        """Restores a state returned by get_state. Returns False if it was created with another cell size"""
+        cell_size_deg, cells, item_cells = state
+        if cell_size_deg != self._cell_size_deg:
+            return False
+
+        self._cells = cells
+        self._item_cells = item_cells
+        return True
+
+    def insert(self, item_id: int, latitude: float, longitude: float):
+        cell = self._get_cell(latitude, longitude)
+        previous_cell = self._item_cells.get(item_id)
+        if previous_cell == cell:
+            return
+
+        if previous_cell is not None:
+            self._remove_from_cell(item_id, previous_cell)
+
+        self._cells.setdefault(cell, set()).add(item_id)
+        self._item_cells[item_id] = cell
+
+    def remove(self, item_id: int):
+        previous_cell = self._item_cells.pop(item_id, None)
+        if previous_cell is not None:
+            self._remove_from_cell(item_id, previous_cell)
+
+    def query(self, latitude: float, longitude: float, radius_km: float) -> list[int]:
+        """Returns the ids of all items in cells which may contain points within radius_km.
+        The result is a superset of the matching items, callers still need to apply an exact distance check.
+        """
+        lat_span = int(radius_km / self._KM_PER_DEGREE_LAT / self._cell_size_deg) + 1
+        # avoid division by zero near the poles, Singapore is nowhere near them anyway
+        lng_scale = max(cos(radians(latitude)), 0.01)
+        lng_span = int(radius_km / (self._KM_PER_DEGREE_LAT * lng_scale) / self._cell_size_deg) + 1
+
+        center_lat, center_lng = self._get_cell(latitude, longitude)
+        candidates = list[int]()
+        for cell_lat in range(center_lat - lat_span, center_lat + lat_span + 1):
+            for cell_lng in range(center_lng - lng_span, center_lng + lng_span + 1):
+                cell = self._cells.get((cell_lat, cell_lng))
+                if cell is not None:
+                    candidates.extend(cell)
+
+        return candidates
+
+    def _get_cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        return floor(latitude / self._cell_size_deg), floor(longitude / self._cell_size_deg)
+
+    def _remove_from_cell(self, item_id: int, cell: tuple[int, int]):
+        items = self._cells.get(cell)
+        if items is None:
+            return
+
+        items.discard(item_id)
+        if len(items) == 0:
+            del self._cells[cell]
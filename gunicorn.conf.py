@@ -0,0 +1,30 @@
+# gunicorn -c gunicorn.conf.py
+# The app is created once in the master process and the places cache is loaded before the workers are forked,
+# they share its memory copy-on-write. Every worker has its own copy of the caches, so more than one worker needs
+# "PlacesCacheBackend": "sqlite" in api_keys.json, create_app refuses to start otherwise. Conversations and place
+# resolutions are then stored in sqlite as well. The TIH response and LLM query caches are kept in memory per
+# worker, TIHResponseCacheFile and LLMQueryCacheFile are neither loaded nor saved.
+import json
+import multiprocessing
+import os
+
+keys_file = os.environ.get("API_KEYS_FILE", "api_keys.json")
+with open(keys_file, "r") as file:
+    places_cache_backend = json.load(file).get("PlacesCacheBackend", "json")
+
+default_workers = min(multiprocessing.cpu_count(), 4) if places_cache_backend == "sqlite" else 1
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+wsgi_app = f"app:create_app({keys_file!r}, preload=True, workers={workers})"
+preload_app = True
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+# the stream endpoint keeps a thread busy while the llm answers
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 4))
+timeout = 120
+
+
+def post_fork(server, worker):
+    # the worker closes its own services on exit, the master only loaded the shared data
+    import app
+    app.services.claim()
+    app.services.start_warm_up()
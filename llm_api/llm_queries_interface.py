@@ -1,8 +1,10 @@
+from typing import Callable
 from llm_api.llm_models import LLMResponse
 
 
 class ILLMQueries:
-    def collect_user_data(self, conversation: list[dict[str, str]]) -> LLMResponse:
+    def collect_user_data(self, conversation: list[dict[str, str]],
+                          on_text: Callable[[str], None] | None = None) -> LLMResponse:
         pass
 
     def get_keywords(self, conversation: list[dict[str, str]]) -> list[str]:
@@ -10,3 +12,7 @@ class ILLMQueries:
 
     def filter_datasets(self, conversation: list[dict[str, str]], possible_datasets: list[str]) -> list[str]:
         pass
+
+    def select_datasets_and_keywords(self, conversation: list[dict[str, str]],
+                                     possible_datasets: list[str]) -> tuple[list[str], list[str]]:
+        pass
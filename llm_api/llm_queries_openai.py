@@ -1,20 +1,37 @@
-from typing import Iterable
+from typing import Iterable, Callable
 from openai import OpenAI, NotGiven, NOT_GIVEN
 from openai.types.chat import ChatCompletionMessageParam
 import json
+import re
 import time
 
+from common.ttl_cache import TTLCache
+from common.metrics import REGISTRY
 from llm_api.llm_queries_interface import ILLMQueries
 from llm_api.llm_models import LLMResponse, LLMResponseType
 
+_REQUEST_SECONDS = REGISTRY.histogram("llm_request_seconds", "Duration of single completion requests",
+                                      ("purpose",))
+_FIRST_TEXT_SECONDS = REGISTRY.histogram("llm_first_text_seconds",
+                                         "Time until the first text of a streamed completion arrived", ("purpose",))
+_QUERY_SECONDS = REGISTRY.histogram("llm_query_seconds",
+                                    "Duration of a query analysis including retries and fallbacks", ("query",))
+_MEMO = REGISTRY.counter("llm_query_memo_total", "Query analysis results found in the memo cache",
+                         ("query", "result"))
 
 class OpenAILLMQueries(ILLMQueries):
-    def __init__(self, api_key, model):
+    def __init__(self, api_key, model, memo_cache: TTLCache | None = None):
         self._client = OpenAI(api_key=api_key)
         self._model = model
+        # results of the helper queries are reused for conversations with the same user visible content
+        self._memo_cache = memo_cache
 
     def _generate_llm_response(self, conversation: list[dict[str, str]], response_start: str = None, system_prompt: str = None,
-                              tools: Iterable[ChatCompletionMessageParam] | NotGiven = NOT_GIVEN) -> LLMResponse:
+                              tools: Iterable[ChatCompletionMessageParam] | NotGiven = NOT_GIVEN,
+                              tool_choice: dict | NotGiven = NOT_GIVEN,
+                              on_text: Callable[[str], None] | None = None, purpose: str = "other") -> LLMResponse:
+        """Requests a completion. If on_text is given the response is streamed and on_text is called with every
+        piece of text as it arrives, the returned LLMResponse is the same as without streaming."""
         messages = []
 
         if system_prompt is not None:
@@ -25,24 +42,79 @@ class OpenAILLMQueries(ILLMQueries):
         if response_start is not None:
             messages.append({"role": "assistant", "content": response_start})
 
-        start = time.time()
-        response = self._client.chat.completions.create(
-            model=self._model,
-            messages=messages,
-            tools=tools)
-        end = time.time()
-        print(f"LLM request took {end - start} seconds")
+        if on_text is not None:
+            return self._generate_streamed_llm_response(messages, tools, tool_choice, on_text, purpose)
+
+        with _REQUEST_SECONDS.time(purpose=purpose):
+            response = self._client.chat.completions.create(
+                model=self._model,
+                messages=messages,
+                tools=tools,
+                tool_choice=tool_choice)
 
         #print(response)
-        if response.choices[0].finish_reason == 'tool_calls':
+        # a forced tool choice finishes with 'stop' even though the message contains the tool call
+        if response.choices[0].finish_reason == 'tool_calls' or response.choices[0].message.tool_calls:
             tool_call = response.choices[0].message.tool_calls[0]
+            # plain dicts, the tool calls become part of the conversation which may be serialised
             return LLMResponse(LLMResponseType.FUNCTION, "", tool_call.id, tool_call.function.name,
                                json.loads(tool_call.function.model_dump()['arguments']),
-                               response.choices[0].message.tool_calls)
+                               [call.model_dump(exclude_none=True) for call in response.choices[0].message.tool_calls])
         else:
             return LLMResponse(LLMResponseType.TEXT, response.choices[0].message.content, "", "", dict(), list())
 
-    def collect_user_data(self, conversation: list[dict[str, str]]) -> LLMResponse:
+    def _generate_streamed_llm_response(self, messages: list[dict[str, str]],
+                                        tools: Iterable[ChatCompletionMessageParam] | NotGiven,
+                                        tool_choice: dict | NotGiven, on_text: Callable[[str], None],
+                                        purpose: str) -> LLMResponse:
+        start = time.perf_counter()
+        stream = self._client.chat.completions.create(
+            model=self._model,
+            messages=messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            stream=True)
+
+        text_parts = list[str]()
+        # tool calls arrive in fragments, the index identifies the call a fragment belongs to
+        tool_calls = dict[int, dict]()
+        first_chunk_time = None
+        for chunk in stream:
+            if len(chunk.choices) == 0:
+                continue
+
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter()
+                    _FIRST_TEXT_SECONDS.observe(first_chunk_time - start, purpose=purpose)
+                text_parts.append(delta.content)
+                on_text(delta.content)
+
+            for tool_call_delta in delta.tool_calls or list():
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {
+                    "id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function is not None:
+                    if tool_call_delta.function.name:
+                        tool_call["function"]["name"] = tool_call_delta.function.name
+                    if tool_call_delta.function.arguments:
+                        tool_call["function"]["arguments"] = (tool_call["function"]["arguments"]
+                                                              + tool_call_delta.function.arguments)
+
+        _REQUEST_SECONDS.observe(time.perf_counter() - start, purpose=purpose)
+
+        if len(tool_calls) > 0:
+            tool_call_list = [tool_calls[index] for index in sorted(tool_calls)]
+            tool_call = tool_call_list[0]
+            return LLMResponse(LLMResponseType.FUNCTION, "", tool_call["id"], tool_call["function"]["name"],
+                               json.loads(tool_call["function"]["arguments"]), tool_call_list)
+        else:
+            return LLMResponse(LLMResponseType.TEXT, "".join(text_parts), "", "", dict(), list())
+
+    def collect_user_data(self, conversation: list[dict[str, str]],
+                          on_text: Callable[[str], None] | None = None) -> LLMResponse:
         # You are a helpful tourist assistant for Singapore.
         system_prompt = """
         You help a tourism agency provide personalised recommendations to clients for their trip to Singapore. 
@@ -66,7 +138,8 @@ class OpenAILLMQueries(ILLMQueries):
         Include the Name, Description, Website, Address and rating information for each recommendations if available.
         """
 
-        return self._generate_llm_response(conversation, system_prompt=system_prompt, tools=[{
+        return self._generate_llm_response(conversation, system_prompt=system_prompt, on_text=on_text,
+                                           purpose="collect_user_data", tools=[{
             "type": "function",
             "function": {
                 "name": "getRecommendations",
@@ -112,15 +185,19 @@ class OpenAILLMQueries(ILLMQueries):
         }])
 
     def get_query_keywords(self, conversation: list[dict[str, str]]) -> list[str]:
-        start = time.time()
+        memo_key = self._create_memo_key("keywords", conversation)
+        cached_keywords = self._get_memoised(memo_key, "keywords")
+        if cached_keywords is not None:
+            return list(cached_keywords)
+
         simplified_conversation = list()
         for data in conversation:
             if 'content' in data:
                 simplified_conversation.append(data['content'])
 
-        keywords = self._get_query_keywords(simplified_conversation)
-        end = time.time()
-        print(f"Keywords LLM request took {end - start} seconds")
+        with _QUERY_SECONDS.time(query="keywords"):
+            keywords = self._get_query_keywords(simplified_conversation)
+        self._memoise(memo_key, keywords)
         return keywords
 
     def filter_datasets(self, conversation: list[dict[str, str]], possible_datasets: list[str]) -> list[str]:
@@ -133,7 +210,12 @@ class OpenAILLMQueries(ILLMQueries):
         Returns:
             list[str]: The elements of possible_datasets which are relevant to the user's query
         """
-        start = time.time()
+        memo_key = self._create_memo_key("datasets", conversation, possible_datasets)
+        cached_datasets = self._get_memoised(memo_key, "dataset_filter")
+        if cached_datasets is not None:
+            return list(cached_datasets)
+
+        start = time.perf_counter()
         str_possible_datasets = ", ".join(possible_datasets)
         str_conversation = ""
         for message in conversation:
@@ -152,13 +234,97 @@ class OpenAILLMQueries(ILLMQueries):
             "Your response should be one category if possible otherwise a comma separated list of categories and nothing else"
         ))
 
-        filtered_datasets = self._generate_llm_response(list(), system_prompt=system_prompt).response_text
+        filtered_datasets = self._generate_llm_response(list(), system_prompt=system_prompt,
+                                                        purpose="dataset_filter").response_text
         filtered_datasets = filtered_datasets.split(",")
         filtered_datasets = [item.strip() for item in filtered_datasets]
-        end = time.time()
-        print(f"Dataset filter LLM request took {end - start} seconds")
+        _QUERY_SECONDS.observe(time.perf_counter() - start, query="dataset_filter")
+        self._memoise(memo_key, filtered_datasets)
         return filtered_datasets
 
+    def select_datasets_and_keywords(self, conversation: list[dict[str, str]],
+                                     possible_datasets: list[str]) -> tuple[list[str], list[str]]:
+        """Combines filter_datasets and get_query_keywords into a single LLM request.
+        The datasets are restricted to possible_datasets by the function schema and validated again afterwards.
+        If the response is not valid the separate requests are used instead.
+
+        Args:
+            conversation (list[dict[str, str]]): Conversation between the user and llm
+            possible_datasets (list[str]): The datasets available in the TIH api
+
+        Returns:
+            tuple[list[str], list[str]]: The selected datasets and the search keywords
+        """
+        memo_key = self._create_memo_key("datasets_and_keywords", conversation, possible_datasets)
+        cached_result = self._get_memoised(memo_key, "datasets_and_keywords")
+        if cached_result is not None:
+            return list(cached_result[0]), list(cached_result[1])
+
+        with _QUERY_SECONDS.time(query="datasets_and_keywords"):
+            datasets, keywords = self._select_datasets_and_keywords(conversation, possible_datasets)
+        self._memoise(memo_key, [datasets, keywords])
+        return datasets, keywords
+
+    def _select_datasets_and_keywords(self, conversation: list[dict[str, str]],
+                                      possible_datasets: list[str]) -> tuple[list[str], list[str]]:
+        str_conversation = ""
+        for message in conversation:
+            if 'tool' != message['role'] and 'content' in message:
+                str_conversation = f"{str_conversation}\n{message['role']}:{message['content']}"
+
+        system_prompt = "\n".join((
+            "You prepare a search for recommendations for a customer visiting Singapore.",
+            "Choose which of the given categories fit best for the conversation. If multiple categories fit choose "
+            "the category that fits best with the latest part of the conversation.",
+            "Break the conversation down into a maximum of 10 important keywords. Each keyword has at most two words "
+            "and must be a valid url argument, therefore characters such as / or . are not allowed.",
+            "You should not respond to questions within the conversation.",
+            "",
+            "conversation:",
+            str_conversation
+        ))
+
+        response = self._generate_llm_response(list(), system_prompt=system_prompt, tools=[{
+            "type": "function",
+            "function": {
+                "name": "searchRecommendations",
+                "description": "Search the tourism database with the given categories and keywords",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "categories": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": possible_datasets},
+                            "description": "one category if possible otherwise the categories that fit best"
+                        },
+                        "keywords": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "up to 10 search keywords, for example: family-friendly, music, rock"
+                        }
+                    },
+                    "required": ["categories", "keywords"]
+                }
+            }
+        }], tool_choice={"type": "function", "function": {"name": "searchRecommendations"}},
+            purpose="datasets_and_keywords")
+
+        datasets = list[str]()
+        keywords = list[str]()
+        if response.response_type == LLMResponseType.FUNCTION:
+            datasets = [item.strip() for item in response.response_function_arguments.get('categories', list())]
+            keywords = [item.strip() for item in response.response_function_arguments.get('keywords', list())]
+
+        if len(datasets) == 0 or any(dataset not in possible_datasets for dataset in datasets):
+            print(f"invalid datasets selected: {datasets}, falling back to separate requests")
+            return self.filter_datasets(conversation, possible_datasets), self.get_query_keywords(conversation)
+
+        if not self._validate_keywords(keywords):
+            print(f"invalid keywords: {keywords}, falling back to separate request")
+            return datasets, self.get_query_keywords(conversation)
+
+        return datasets, keywords
+
     def _get_query_keywords(self, conversation: list[str], retries: int = 5) -> list[str]:
         system_prompt = """ Your are supporting with breaking down a text that is about recommendations for visiting Singapore.
         The text should be broken down into a few important keywords.
@@ -186,14 +352,44 @@ class OpenAILLMQueries(ILLMQueries):
         Your response should be only keywords comma separated nothing else  
         """
         system_prompt = system_prompt.replace("<conversation>", "\n".join(conversation))
-        keywords_response = self._generate_llm_response(list(), system_prompt=system_prompt).response_text
+        keywords_response = self._generate_llm_response(list(), system_prompt=system_prompt,
+                                                        purpose="keywords").response_text
         keywords = keywords_response.split(", ")
         if self._validate_keywords(keywords):
             return keywords
+        elif retries <= 0:
+            # out of retries, keep the keywords which are usable instead of failing the recommendation
+            return [keyword for keyword in keywords if 0 < len(keyword.split(' ')) <= 2 and len(keyword) > 0]
         else:
             # TODO CROP old conversation?
             return self._get_query_keywords(conversation, retries - 1)
 
+    def _create_memo_key(self, purpose: str, conversation: list[dict[str, str]],
+                         possible_datasets: list[str] | None = None) -> str | None:
+        if self._memo_cache is None:
+            return None
+
+        # casing, punctuation and whitespace don't change the intent of a message
+        normalised_conversation = list[str]()
+        for message in conversation:
+            if 'tool' != message['role'] and message.get('content'):
+                content = re.sub(r"[^\w\s]", " ", message['content'].lower())
+                normalised_conversation.append(f"{message['role']}:{' '.join(content.split())}")
+
+        datasets = sorted(possible_datasets) if possible_datasets is not None else None
+        return json.dumps([self._model, purpose, datasets, normalised_conversation])
+
+    def _get_memoised(self, memo_key: str | None, query: str):
+        if memo_key is None:
+            return None
+        value = self._memo_cache.get(memo_key)
+        _MEMO.inc(query=query, result="hit" if value is not None else "miss")
+        return value
+
+    def _memoise(self, memo_key: str | None, value):
+        if memo_key is not None:
+            self._memo_cache.put(memo_key, value)
+
     def _validate_keywords(self, keywords: list[str]):
         for keyword in keywords:
             if len(keyword.split(' ')) > 2:
@@ -0,0 +1,277 @@
+import os
+import threading
+from datetime import timedelta
+
+from enrich_places_api.cache_interface import ICache
+from enrich_places_api.cache_json import JsonFileCache
+from enrich_places_api.cache_sqlite import SqliteCache
+from enrich_places_api.places_lookup_google import GooglePlacesLookup
+from enrich_places_api.image_variants import ImageVariantStore
+from enrich_places_api.place_resolution_store import (IPlaceResolutionStore, PlaceResolutionStore,
+                                                       SqlitePlaceResolutionStore)
+from enrich_places_api.cache_refresh_scheduler import CacheRefreshScheduler
+from llm_api.llm_queries_openai import OpenAILLMQueries
+from tih_api.tih_api import TIHAPI
+from tih_api.tool_payload import ToolPayloadBuilder
+from common.ttl_cache import TTLCache
+from common.conversation_store import IConversationStore, InMemoryConversationStore, SqliteConversationStore
+
+
+class Services:
+    """Builds the api clients, caches and stores from the api keys file settings, each on first use.
+
+    preload loads the data heavy parts which are safe to share with forked processes: the places cache, the
+    place resolutions and the response caches. Nothing started by it runs a thread or holds a connection.
+    Components are closed in the reverse order they were built, only by the process which owns them.
+
+    workers is the number of processes serving the app. Each of them has its own copy of the components, so with
+    more than one the places cache, the place resolutions and the conversations have to be stored in sqlite and
+    the response caches are not saved, each worker would overwrite the files with its own entries.
+    With the sqlite places cache the place resolutions are stored in the same database.
+    """
+
+    def __init__(self, keys: dict, workers: int = 1):
+        self.tih_api_key = keys["TIH"]
+        self.google_api_key = keys.get("GoogleAPI")
+        self.openai_api_key = keys["OpenAI"]
+        os.environ["OPENAI_API_KEY"] = self.openai_api_key
+        self.model = keys["LLMModel"]
+        self.download_images = keys['download_places_image']
+        self.max_tih_cache_age = keys["MaxCacheAgeTIHDataset"]
+        self.places_cache_backend = keys.get("PlacesCacheBackend", "json")
+        self.places_cache_journal = keys.get("PlacesCacheJournal", False)
+        self.places_cache_compact_records = keys.get("PlacesCacheCompactRecords", False)
+        self.places_cache_snapshot = keys.get("PlacesCacheSnapshot", "")
+        self.enrichment_workers = keys.get("EnrichmentWorkers", 1)
+        self.prefetch_tih_pages = keys.get("PrefetchTIHPages", False)
+        self.fan_out_tih_datasets = keys.get("FanOutTIHDatasets", False)
+        self.place_resolution_file = keys.get("PlaceResolutionFile", "")
+        self.tih_request_timeout = tuple(keys.get("TIHRequestTimeout", [3.05, 30]))
+        self.tih_request_retries = keys.get("TIHRequestRetries", 3)
+        self.tih_response_cache_ttl = keys.get("TIHResponseCacheTTL", 0)
+        self.tih_response_cache_size = keys.get("TIHResponseCacheSize", 500)
+        self.tih_response_cache_file = keys.get("TIHResponseCacheFile", "")
+        self.combined_query_analysis = keys.get("CombinedQueryAnalysis", False)
+        self.llm_query_cache_ttl = keys.get("LLMQueryCacheTTL", 0)
+        self.llm_query_cache_size = keys.get("LLMQueryCacheSize", 1000)
+        self.llm_query_cache_file = keys.get("LLMQueryCacheFile", "")
+        self.image_download_workers = keys.get("ImageDownloadWorkers", 2)
+        self.image_cache_max_age = keys.get("ImageCacheMaxAge", 31536000)
+        self.conversation_store_backend = keys.get("ConversationStore", "memory")
+        self.conversation_store_file = keys.get("ConversationStoreFile", "conversations.db")
+        self.session_idle_timeout = keys.get("SessionIdleTimeout", 3600)
+        self.max_sessions = keys.get("MaxSessions", 1000)
+        self.cache_refresh_enabled = keys.get("CacheRefreshEnabled", False)
+        self.cache_refresh_budget = keys.get("CacheRefreshApiCallsPerHour", 100)
+        self.cache_refresh_interval = keys.get("CacheRefreshInterval", 300)
+        self.cached_place_max_age_days = keys.get("CachedPlaceMaxAgeDays", 30)
+        self.negative_lookup_max_age_days = keys.get("NegativeLookupMaxAgeDays", 7)
+        self.cache_refresh_lock_file = keys.get("CacheRefreshLockFile", "cache_refresh.lock")
+        self.tool_payload_token_budget = keys.get("ToolPayloadTokenBudget", 3000)
+        self.tool_payload_description_chars = keys.get("ToolPayloadDescriptionChars", 300)
+        self.tool_payload_body_chars = keys.get("ToolPayloadBodyChars", 600)
+        self.workers = workers
+
+        if workers > 1 and self.places_cache_backend != "sqlite":
+            # every worker would rewrite the json files from its own copy and drop the places the others added
+            raise ValueError(f"{workers} workers need \"PlacesCacheBackend\": \"sqlite\", "
+                             f"the {self.places_cache_backend} places cache only supports a single worker")
+        if workers > 1 and self.conversation_store_backend == "memory":
+            # the next request of a session usually reaches another worker, which wouldn't know its conversation
+            print(f"{workers} workers can't share conversations in memory, using the sqlite conversation store "
+                  f"{self.conversation_store_file}")
+            self.conversation_store_backend = "sqlite"
+        if workers > 1:
+            # every worker would overwrite the files with its own entries on exit, the caches stay in memory
+            self.tih_response_cache_file = ""
+            self.llm_query_cache_file = ""
+
+        # built components by name in the order they were built, optional components may be None
+        self._components = dict[str, object]()
+        self._lock = threading.RLock()
+        self._owner_pid = os.getpid()
+        self._warm_up_thread = None
+        self._ready = threading.Event()
+
+    @property
+    def conversation_store(self) -> IConversationStore:
+        return self._get("conversation_store", self._create_conversation_store)
+
+    @property
+    def cache(self) -> ICache:
+        return self._get("cache", self._create_cache)
+
+    @property
+    def image_variants(self) -> ImageVariantStore:
+        return self._get("image_variants", ImageVariantStore)
+
+    @property
+    def places(self) -> GooglePlacesLookup:
+        return self._get("places", self._create_places)
+
+    @property
+    def place_resolutions(self) -> IPlaceResolutionStore | None:
+        return self._get("place_resolutions", self._create_place_resolutions)
+
+    @property
+    def tih_response_cache(self) -> TTLCache | None:
+        return self._get("tih_response_cache", self._create_tih_response_cache)
+
+    @property
+    def tih_api(self) -> TIHAPI:
+        return self._get("tih_api", self._create_tih_api)
+
+    @property
+    def llm_query_cache(self) -> TTLCache | None:
+        return self._get("llm_query_cache", self._create_llm_query_cache)
+
+    @property
+    def llm(self) -> OpenAILLMQueries:
+        return self._get("llm", self._create_llm)
+
+    @property
+    def tool_payload(self) -> ToolPayloadBuilder:
+        return self._get("tool_payload", self._create_tool_payload)
+
+    def preload(self):
+        # a sqlite connection must not be shared with forked processes, its data stays on disk anyway
+        if self.places_cache_backend != "sqlite":
+            self.cache
+            self.place_resolutions
+        self.tih_response_cache
+        self.llm_query_cache
+
+    def warm_up(self):
+        """Builds everything preload does and the places cache of any backend in this process, afterwards the
+        services are ready"""
+        self.preload()
+        self.cache
+        self.place_resolutions
+        self._ready.set()
+
+    def start_warm_up(self):
+        """Runs warm_up on a background thread, once"""
+        with self._lock:
+            if self._warm_up_thread is None:
+                self._warm_up_thread = threading.Thread(target=self._run_warm_up, name="services-warm-up",
+                                                        daemon=True)
+                self._warm_up_thread.start()
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def get_built_components(self) -> list[str]:
+        with self._lock:
+            return [name for name, component in self._components.items() if component is not None]
+
+    def release(self):
+        """Gives up the ownership, e.g. in a process which forks workers. Only the owner closes the components"""
+        self._owner_pid = None
+
+    def claim(self):
+        """Makes the current process the owner, called in a worker after it was forked"""
+        self._owner_pid = os.getpid()
+        # the thread and the event may have been copied from the parent process
+        self._warm_up_thread = None
+        self._ready = threading.Event()
+
+    def close(self):
+        if self._owner_pid != os.getpid():
+            return
+
+        with self._lock:
+            components = list(self._components.values())
+            self._components = dict[str, object]()
+
+        for component in reversed(components):
+            if component is not None and hasattr(component, "close"):
+                component.close()
+
+    def _run_warm_up(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            print(f"warming up the services failed: {e}")
+            # the next readiness check starts another attempt
+            with self._lock:
+                self._warm_up_thread = None
+
+    def _get(self, name: str, create):
+        # the lock is only taken until a component is built
+        if name in self._components:
+            return self._components[name]
+
+        with self._lock:
+            if name not in self._components:
+                component = create()
+                self._components[name] = component
+            return self._components[name]
+
+    def _create_conversation_store(self) -> IConversationStore:
+        # Conversations are stored per session. The sqlite store is shared by all worker processes.
+        if self.conversation_store_backend == "sqlite":
+            return SqliteConversationStore(self.conversation_store_file, self.max_sessions,
+                                           self.session_idle_timeout)
+        return InMemoryConversationStore(self.max_sessions, self.session_idle_timeout)
+
+    def _create_cache(self) -> ICache:
+        if self.places_cache_backend == "sqlite":
+            # an empty database is seeded from the json cache files
+            cache = SqliteCache('places_cache.db', 'places_cache.json', 'places_cache_requests.json')
+        else:
+            cache = JsonFileCache('places_cache.json', 'places_cache_requests.json', journal=self.places_cache_journal,
+                                  compact_records=self.places_cache_compact_records,
+                                  snapshot_path=self.places_cache_snapshot)
+        cache.load_cache()
+        return cache
+
+    def _create_places(self) -> GooglePlacesLookup:
+        return GooglePlacesLookup(self.google_api_key, self.cache, self.download_images, self.image_download_workers,
+                                  image_variants=self.image_variants, load_cache=False)
+
+    def _create_place_resolutions(self) -> IPlaceResolutionStore | None:
+        if len(self.place_resolution_file) == 0:
+            return None
+        if self.places_cache_backend == "sqlite":
+            # an empty table is seeded from the json resolutions file
+            return SqlitePlaceResolutionStore('places_cache.db', self.place_resolution_file)
+        return PlaceResolutionStore(self.place_resolution_file)
+
+    def _create_tih_response_cache(self) -> TTLCache | None:
+        if self.tih_response_cache_ttl <= 0:
+            return None
+        return TTLCache(self.tih_response_cache_ttl, self.tih_response_cache_size, self.tih_response_cache_file)
+
+    def _create_cache_refresher(self) -> CacheRefreshScheduler | None:
+        # stale places and expired misses are re-validated in the background within the hourly api budget
+        if not self.cache_refresh_enabled or not self.places.can_search():
+            return None
+
+        cache_refresher = CacheRefreshScheduler(self.places, self.cache, self.place_resolutions,
+                                                self.cache_refresh_budget,
+                                                timedelta(days=self.cached_place_max_age_days),
+                                                timedelta(days=self.negative_lookup_max_age_days),
+                                                self.cache_refresh_interval,
+                                                self.cache_refresh_lock_file if self.workers > 1 else "")
+        cache_refresher.start()
+        return cache_refresher
+
+    def _create_tih_api(self) -> TIHAPI:
+        places = self.places
+        self._get("cache_refresher", self._create_cache_refresher)
+        return TIHAPI(self.tih_api_key, places, "tih_datasets_cache.json", self.max_tih_cache_age,
+                      self.enrichment_workers, self.prefetch_tih_pages, timeout=self.tih_request_timeout,
+                      retries=self.tih_request_retries, response_cache=self.tih_response_cache,
+                      fan_out_datasets=self.fan_out_tih_datasets, resolutions=self.place_resolutions)
+
+    def _create_llm_query_cache(self) -> TTLCache | None:
+        if self.llm_query_cache_ttl <= 0:
+            return None
+        return TTLCache(self.llm_query_cache_ttl, self.llm_query_cache_size, self.llm_query_cache_file)
+
+    def _create_llm(self) -> OpenAILLMQueries:
+        return OpenAILLMQueries(self.openai_api_key, self.model, self.llm_query_cache)
+
+    def _create_tool_payload(self) -> ToolPayloadBuilder:
+        return ToolPayloadBuilder(self.tool_payload_token_budget, self.tool_payload_description_chars,
+                                  self.tool_payload_body_chars)
@@ -1,10 +1,12 @@
 import re
 
-def format_api_response(api_response: dict[str, any]) -> str:
+def format_api_response(api_response: dict[str, any], max_description_chars: int = 0, max_body_chars: int = 0) -> str:
     """Transforms the dictionary returned by the api into a string which can be processed by the llm
 
     Args:
         api_response (dict[str, any]): The list of results from the API
+        max_description_chars (int): Length the description is shortened to, 0 keeps all of it
+        max_body_chars (int): Length the body is shortened to, 0 keeps all of it
 
     Returns:
         str: A string formatted to be interpretted by the llm
@@ -28,26 +30,38 @@ def format_api_response(api_response: dict[str, any]) -> str:
     #TODO add opening hours
 
 
-    # Some responses contain newlines to format more nicely for a human reader. Remove these as it may lead to confusion to a machine reader, especially since we are using newlines to distinguish between name, description and body.
-    name = name.replace("\n", " ")
-    description = description.replace("\n", " ")
-    body = body.replace("\n", " ")
-    
-    # Some responses contain html, which doesn't add anything to the text and makes the result more difficult to read for debugging
-    regex = r"<.*?>"
-    
-    name = re.sub(regex, "", name)
-    description = re.sub(regex, "", description)
-    body = re.sub(regex, "", body)
-    
-    
-    # Regular expression to match any character outside the ASCII range
-    # We remove such characters as they are unlikely to appear frequently, if at all, in llm training
-    # TODO consider how I can exclude currency codes from this
-    regex = r"[^\x00-\x7F]"
-    
-    name = re.sub(regex, "", name)
-    description = re.sub(regex, "", description)
-    body = re.sub(regex, "", body)
-    
-    return f"{name}\n{description}\n{body}"
\ No newline at end of file
+    name = clean_text(name)
+    description = clean_text(description)
+    body = clean_text(body)
+    if max_description_chars > 0:
+        description = truncate_text(description, max_description_chars)
+    if max_body_chars > 0:
+        body = truncate_text(body, max_body_chars)
+
+    return f"{name}\n{description}\n{body}"
+
+
+# Some responses contain newlines to format more nicely for a human reader. Remove these as it may lead to confusion
+# to a machine reader, especially since we are using newlines to distinguish between name, description and body.
+# Some responses contain html, which doesn't add anything to the text and makes the result more difficult to read.
+# Characters outside the ASCII range are removed as they are unlikely to appear frequently, if at all, in llm training
+# TODO consider how I can exclude currency codes from this
+_TAG_PATTERN = re.compile(r"<.*?>", re.DOTALL)
+
+
+def clean_text(text: str) -> str:
+    """Removes newlines, html tags and non ASCII characters. Tags may span lines, so the only regex pass runs first"""
+    text = _TAG_PATTERN.sub("", text)
+    if not text.isascii():
+        text = text.encode("ascii", "ignore").decode("ascii")
+    return text.replace("\n", " ")
+
+
+def truncate_text(text: str, max_chars: int) -> str:
+    """Shortens the text to at most max_chars, cut at a word boundary"""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max(max_chars - 3, 0)]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip(" ,;:.") + "..."
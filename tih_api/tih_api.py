@@ -1,11 +1,32 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import json
 from enrich_places_api.places_lookup_google import IPlacesLookup
-import time
+from enrich_places_api.place_resolution_store import IPlaceResolutionStore
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from common.ttl_cache import TTLCache
+from common.metrics import REGISTRY
+
+_REQUEST_SECONDS = REGISTRY.histogram("tih_api_request_seconds", "Duration of requests to the TIH api",
+                                      ("endpoint",))
+_RESPONSE_CACHE = REGISTRY.counter("tih_response_cache_total", "TIH search responses found in the response cache",
+                                   ("result",))
+_ENRICHMENT_SECONDS = REGISTRY.histogram("tih_enrichment_seconds",
+                                         "Duration of enriching a page of TIH records with google data")
+_ENRICHED_RECORDS = REGISTRY.counter("tih_enriched_records_total", "TIH records enriched with google data",
+                                     ("result",))
+_RESOLUTIONS = REGISTRY.counter("place_resolution_total", "Lookups of TIH records in the place resolution store",
+                                ("result",))
 
 class TIHAPI:
-    def __init__(self, tih_api_key: str,  places: IPlacesLookup, dataset_cache_file_path: str, max_cache_age: int = 6000):
+    def __init__(self, tih_api_key: str,  places: IPlacesLookup, dataset_cache_file_path: str, max_cache_age: int = 6000,
+                 enrichment_workers: int = 1, prefetch_pages: bool = False, session: requests.Session | None = None,
+                 timeout: tuple[float, float] = (3.05, 30), retries: int = 3, backoff_factor: float = 0.5,
+                 response_cache: TTLCache | None = None, fan_out_datasets: bool = False,
+                 resolutions: IPlaceResolutionStore | None = None):
         self._tih_api_key = tih_api_key
         self._places = places
         self._datasets_cache = list[str]()
@@ -13,20 +34,103 @@ class TIHAPI:
         self._max_cache_age = max_cache_age
         self._dataset_cache_file_path = dataset_cache_file_path
         self._hidden_gem_dataset_type_filter = ['food_beverages', 'bars_clubs', 'shops', 'attractions']
+        # (connect, read) timeout in seconds for every request to the TIH api
+        self._timeout = timeout
+        self._request_count = 0
+        self._response_cache = response_cache
+        # known matches of TIH records with google places, see _enrich_data
+        self._resolutions = resolutions
+        self._session = session if session is not None else self._create_session(retries, backoff_factor,
+                                                                                  enrichment_workers + 4)
+        # items of a page are enriched concurrently when more than one worker is configured.
+        # The places lookup and its cache must be thread safe in that case.
+        self._enrichment_executor = None
+        if enrichment_workers > 1:
+            self._enrichment_executor = ThreadPoolExecutor(max_workers=enrichment_workers,
+                                                           thread_name_prefix="tih-enrichment")
+        # with prefetching the next page is requested while the current page is enriched
+        self._prefetch_executor = None
+        if prefetch_pages:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tih-prefetch")
+        # with fan out every dataset is searched separately and concurrently
+        self._fan_out_executor = None
+        if fan_out_datasets:
+            self._fan_out_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tih-fan-out")
         self._read_dataset_cache()
 
     def multiple_datasets_by_keywords(self, datasets: list[str], keywords: list[str], limit: int,
                                       start_date: datetime, end_date: datetime, expected_result_count: int = 10)\
             -> list[dict[str, any]]:
+        if self._fan_out_executor is not None and len(datasets) > 1:
+            return self._fan_out_datasets_by_keywords(datasets, keywords, limit, start_date, end_date,
+                                                      expected_result_count)
+
         valid_responses = list[dict[str, any]]()
 
         offset = 0
+        next_page = None
+        needs_hidden_gem_filter = any(item in datasets for item in self._hidden_gem_dataset_type_filter)
+        try:
+            while len(valid_responses) < expected_result_count:
+                if next_page is None:
+                    api_response = self._request_from_api(datasets, keywords, limit, offset, start_date, end_date)
+                else:
+                    api_response = next_page.result()
+                    next_page = None
+
+                if self._prefetch_executor is not None and len(api_response) >= limit:
+                    next_page = self._prefetch_executor.submit(self._request_from_api, datasets, keywords, limit,
+                                                               offset + limit, start_date, end_date)
+
+                self._enrich_with_google_data(api_response)
+
+                # if we don't need to apply the hidden gem filter the data just return the data.
+                if not needs_hidden_gem_filter:
+                    for item in api_response:
+                        if 'google_data' in item:
+                            valid_responses.append(item)
+                else:
+                    self._check_for_hidden_gems(api_response, valid_responses, expected_result_count)
+
+                if len(api_response) < limit:
+                    return valid_responses
+
+                offset = offset + limit
+
+            return valid_responses
+        finally:
+            # the prefetched page is not needed anymore. A request that already started can't be aborted,
+            # its result is simply discarded.
+            if next_page is not None:
+                next_page.cancel()
+
+    def _fan_out_datasets_by_keywords(self, datasets: list[str], keywords: list[str], limit: int,
+                                      start_date: datetime, end_date: datetime, expected_result_count: int)\
+            -> list[dict[str, any]]:
+        """Searches every dataset with its own offset, so a large dataset can't starve the others.
+        The pages of one round are requested concurrently and interleaved before they are enriched."""
+        valid_responses = list[dict[str, any]]()
+        offsets = {dataset: 0 for dataset in datasets}
         needs_hidden_gem_filter = any(item in datasets for item in self._hidden_gem_dataset_type_filter)
-        while len(valid_responses) < expected_result_count:
-            api_response = self._request_from_api(datasets, keywords, limit, offset, start_date, end_date)
+        while len(valid_responses) < expected_result_count and len(offsets) > 0:
+            futures = {dataset: self._fan_out_executor.submit(self._request_from_api, [dataset], keywords, limit,
+                                                              offset, start_date, end_date)
+                       for dataset, offset in offsets.items()}
+            pages = list[list[dict[str, any]]]()
+            for dataset, future in futures.items():
+                page = future.result()
+                pages.append(page)
+                if len(page) < limit:
+                    # this dataset ran dry
+                    del offsets[dataset]
+                else:
+                    offsets[dataset] = offsets[dataset] + limit
+
+            # fair interleave, the first item of every dataset, then the second item of every dataset, ...
+            api_response = [page[index] for index in range(max(len(page) for page in pages))
+                            for page in pages if index < len(page)]
             self._enrich_with_google_data(api_response)
 
-            # if we don't need to apply the hidden gem filter the data just return the data.
             if not needs_hidden_gem_filter:
                 for item in api_response:
                     if 'google_data' in item:
@@ -34,13 +138,15 @@ class TIHAPI:
             else:
                 self._check_for_hidden_gems(api_response, valid_responses, expected_result_count)
 
-            if len(api_response) < limit:
-                return valid_responses
-
-            offset = offset + limit
-
         return valid_responses
 
+    def fetch_enriched_page(self, datasets: list[str], keywords: list[str], limit: int, offset: int,
+                            start_date: datetime = None, end_date: datetime = None) -> list[dict[str, any]]:
+        """Fetches one page of search results and enriches it with google data, without any filtering"""
+        api_response = self._request_from_api(datasets, keywords, limit, offset, start_date, end_date)
+        self._enrich_with_google_data(api_response)
+        return api_response
+
     def get_datasets(self) -> list[str]:
         if self._datasets_cache_time is None or (datetime.datetime.now() - self._datasets_cache_time).seconds > self._max_cache_age:
             self._datasets_cache = self._request_dataset_list()
@@ -51,6 +157,39 @@ class TIHAPI:
 
         return self._datasets_cache
 
+    def get_connection_stats(self) -> dict[str, int]:
+        """Returns how many requests were made to the TIH api and how many connections had to be opened for them"""
+        connections = 0
+        pooled_requests = 0
+        # the same adapter is mounted for several prefixes
+        adapters = {id(adapter): adapter for adapter in self._session.adapters.values()}
+        for adapter in adapters.values():
+            if not isinstance(adapter, HTTPAdapter):
+                continue
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections = connections + pool.num_connections
+                    pooled_requests = pooled_requests + pool.num_requests
+
+        return {
+            'requests': self._request_count,
+            'connections_opened': connections,
+            'connections_reused': max(pooled_requests - connections, 0)
+        }
+
+    def _create_session(self, retries: int, backoff_factor: float, pool_size: int) -> requests.Session:
+        # Only GET requests are made which are safe to retry. Failed responses are retried as well,
+        # after the last retry the response is returned and raise_for_status reports the error.
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     def _check_for_hidden_gems(self, api_response: list[dict[str, any]], valid_responses: list[dict[str, any]],
                                expected_result_count: int):
         for item in api_response:
@@ -77,15 +216,14 @@ class TIHAPI:
         Returns:
             list[str]: the list of available datasets
         """
-        start = time.time()
         url = "https://api.stb.gov.sg/content/common/v2/datasets"
         headers = {
             "X-API-Key": self._tih_api_key,
             "Content-Type": "application/json"
         }
-        response = requests.get(url, headers=headers)
-        end = time.time()
-        print(f"fetching datasets request took {end - start} seconds")
+        self._request_count = self._request_count + 1
+        with _REQUEST_SECONDS.time(endpoint="datasets"):
+            response = self._session.get(url, headers=headers, timeout=self._timeout)
         if response.status_code == 200:
             return response.json().get("data")
         response.raise_for_status()
@@ -101,27 +239,77 @@ class TIHAPI:
         return (operational and rating_count < max_rating_count and rating >= minimum_rating) or rating_count <= 10
 
     def _enrich_with_google_data(self, api_response):
-        start = time.time()
-        for item in api_response:
-            block, street = self._get_tih_address_data(item)
-            google_data = self._enrich_data(item['name'], block, street, float(item['location']['latitude']),
-                                            float(item['location']['longitude']))
-            if google_data is not None:
-                item['google_data'] = google_data
+        with _ENRICHMENT_SECONDS.time():
+            if self._enrichment_executor is None:
+                for item in api_response:
+                    self._enrich_item(item)
+            else:
+                # consuming the results re-raises exceptions of the workers
+                list(self._enrichment_executor.map(self._enrich_item, api_response))
 
-        end = time.time()
-        print(f"Enriching with google data took {end - start} seconds")
+    def _enrich_item(self, item):
+        block, street = self._get_tih_address_data(item)
+        google_data = self._enrich_data(item['name'], block, street, float(item['location']['latitude']),
+                                        float(item['location']['longitude']), item.get('uuid'))
+        if google_data is not None:
+            item['google_data'] = google_data
+            _ENRICHED_RECORDS.inc(result="matched")
+        else:
+            _ENRICHED_RECORDS.inc(result="unmatched")
 
-    def _enrich_data(self, name: str, block: str, street_name: str, latitude: float, longitude: float):
+    def _enrich_data(self, name: str, block: str, street_name: str, latitude: float, longitude: float,
+                     uuid: str | None = None):
         if float(latitude) == 0.0 and float(longitude) == 0.0:
             print(f"{name} has a invalid geo location in tih.")
             return None
 
-        return self._places.find_place(name, block, street_name, latitude, longitude)
+        if self._resolutions is None or uuid is None:
+            return self._places.find_place(name, block, street_name, latitude, longitude)
+
+        fingerprint = self._resolutions.create_fingerprint(name, block, street_name, latitude, longitude)
+        resolved, place_id = self._resolutions.get(uuid, fingerprint)
+        if resolved:
+            if place_id is None:
+                _RESOLUTIONS.inc(result="no_match")
+                return None
+            google_data = self._places.get_place(place_id)
+            if google_data is not None:
+                _RESOLUTIONS.inc(result="match")
+                return google_data
+            # the place is not cached anymore, resolve the record again
+
+        _RESOLUTIONS.inc(result="miss")
+
+        google_data = self._places.find_place(name, block, street_name, latitude, longitude)
+        inputs = {'name': name, 'block': block, 'streetName': street_name, 'latitude': latitude,
+                  'longitude': longitude}
+        if google_data is not None:
+            self._resolutions.put(uuid, fingerprint, google_data['place_id'], inputs)
+        elif self._places.can_search():
+            # without google access a miss only means the cache doesn't know the place
+            self._resolutions.put(uuid, fingerprint, None, inputs)
+
+        return google_data
 
     def _request_from_api(self, datasets: list[str], keywords: list[str], limit: int, offset: int,
                           start_date: datetime, end_date: datetime, offset_days: int = 5) -> list[dict[str, any]]:
-        start = time.time()
+        start_day, end_day = None, None
+        # If setting start and end date to datasets that do not provide these fields 0 items are returned.
+        # Therefore, only apply for events
+        if 'events' in datasets and start_date is not None and end_date is not None:
+            start_day = (start_date-datetime.timedelta(days=offset_days)).strftime('%Y-%m-%d')
+            end_day = (end_date+datetime.timedelta(days=offset_days)).strftime('%Y-%m-%d')
+
+        cache_key = None
+        if self._response_cache is not None:
+            cache_key = self._create_response_cache_key(datasets, keywords, limit, offset, start_day, end_day)
+            cached_response = self._response_cache.get(cache_key)
+            if cached_response is not None:
+                _RESPONSE_CACHE.inc(result="hit")
+                # the items are enriched in place, the cached response must stay untouched
+                return copy.deepcopy(cached_response)
+            _RESPONSE_CACHE.inc(result="miss")
+
         url = "https://api.stb.gov.sg/content/common/v2/search"
         headers = {
             "X-API-Key": self._tih_api_key,
@@ -137,19 +325,27 @@ class TIHAPI:
             "keyword": ", ".join(keywords)
         }
 
-        # If setting start and end date to datasets that do not provide these fields 0 items are returned.
-        # Therefore, only apply for events
-        if 'events' in datasets and start_date is not None and end_date is not None:
-            query["startDate"] = (start_date-datetime.timedelta(days=offset_days)).strftime('%Y-%m-%d')
-            query["endDate"] = (end_date+datetime.timedelta(days=offset_days)).strftime('%Y-%m-%d')
+        if start_day is not None:
+            query["startDate"] = start_day
+            query["endDate"] = end_day
 
-        response = requests.get(url, headers=headers, params=query)
-        end = time.time()
-        print(f"Fetching tih data took {end - start} seconds")
+        self._request_count = self._request_count + 1
+        with _REQUEST_SECONDS.time(endpoint="search"):
+            response = self._session.get(url, headers=headers, params=query, timeout=self._timeout)
         if response.status_code == 200:
-            return response.json()["data"]
+            data = response.json()["data"]
+            if cache_key is not None:
+                self._response_cache.put(cache_key, copy.deepcopy(data))
+            return data
         response.raise_for_status()
 
+    def _create_response_cache_key(self, datasets: list[str], keywords: list[str], limit: int, offset: int,
+                                   start_day: str | None, end_day: str | None) -> str:
+        # the order and casing of datasets and keywords doesn't change the result of a search
+        normalised_datasets = sorted({dataset.strip().lower() for dataset in datasets})
+        normalised_keywords = sorted({keyword.strip().lower() for keyword in keywords})
+        return json.dumps([normalised_datasets, normalised_keywords, limit, offset, start_day, end_day])
+
     def _write_dataset_cache(self):
         cache_obj = {'cache_data': self._datasets_cache, 'cachedAt': datetime.datetime.today().strftime("%d-%m-%y %H:%M:%S")}
         json_object = json.dumps(cache_obj, indent=4)
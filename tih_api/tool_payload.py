@@ -0,0 +1,102 @@
+import math
+import re
+
+from tih_api.format_api_response import format_api_response
+
+# rough average for english text with the gpt tokenizers, good enough to budget a prompt
+_CHARS_PER_TOKEN = 4
+_ITEM_SEPARATOR = "\n\n"
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class ToolPayloadBuilder:
+    """Builds the tool message content of a recommendation turn from the TIH results.
+
+    The tool message stays in the conversation for every later turn, so it is kept within a token budget: results
+    are ranked by how well they match the keywords and their rating, duplicates are dropped, descriptions and
+    bodies are shortened and results are added until the budget is used up. At least one result is always kept.
+    A token budget of 0 keeps every distinct result with its full text, like before.
+    """
+
+    def __init__(self, token_budget: int = 3000, max_description_chars: int = 300, max_body_chars: int = 600):
+        self._token_budget = token_budget
+        self._max_description_chars = max_description_chars
+        self._max_body_chars = max_body_chars
+
+    def build(self, api_responses: list[dict], keywords: list[str] | None = None) -> tuple[str, list[dict]]:
+        """Returns the tool message content and the results it contains, in the order they appear in it"""
+        api_responses = self._remove_duplicates(api_responses)
+        if self._token_budget <= 0:
+            return _ITEM_SEPARATOR.join(format_api_response(response) for response in api_responses), api_responses
+
+        ranked = self._rank(api_responses, keywords if keywords is not None else list())
+        items = list[str]()
+        selected = list[dict]()
+        tokens = 0
+        for response in ranked:
+            item = format_api_response(response, self._max_description_chars, self._max_body_chars)
+            item_tokens = self._estimate_tokens(item) + (self._estimate_tokens(_ITEM_SEPARATOR) if items else 0)
+            if tokens + item_tokens > self._token_budget:
+                if len(items) > 0:
+                    # a shorter result further down may still fit
+                    continue
+                # the best result is kept with only its name and description
+                item = item.rsplit("\n", 1)[0]
+                item_tokens = self._estimate_tokens(item)
+
+            items.append(item)
+            selected.append(response)
+            tokens = tokens + item_tokens
+
+        print(f"tool payload: {len(selected)}/{len(api_responses)} results, about {tokens} tokens")
+        return _ITEM_SEPARATOR.join(items), selected
+
+    def _remove_duplicates(self, api_responses: list[dict]) -> list[dict]:
+        # the same place is often listed in more than one dataset, e.g. as attraction and as tour
+        seen = set[str]()
+        distinct = list[dict]()
+        for response in api_responses:
+            keys = {response.get('uuid'), self._get_name_key(response)}
+            keys.discard(None)
+            keys.discard("")
+            if len(keys & seen) > 0:
+                continue
+            seen.update(keys)
+            distinct.append(response)
+        return distinct
+
+    def _get_name_key(self, response: dict) -> str:
+        return " ".join(_WORD_PATTERN.findall(str(response.get('name', '')).lower()))
+
+    def _rank(self, api_responses: list[dict], keywords: list[str]) -> list[dict]:
+        keyword_words = [set(_WORD_PATTERN.findall(keyword.lower())) for keyword in keywords]
+        keyword_words = [words for words in keyword_words if len(words) > 0]
+        scores = [self._score(response, keyword_words) for response in api_responses]
+        # sorted is stable, results with the same score keep the order of the TIH search
+        order = sorted(range(len(api_responses)), key=lambda index: -scores[index])
+        return [api_responses[index] for index in order]
+
+    def _score(self, response: dict, keyword_words: list[set[str]]) -> float:
+        name_words = set(_WORD_PATTERN.findall(str(response.get('name', '')).lower()))
+        tags = response.get('tags') or list()
+        other_words = set(_WORD_PATTERN.findall(f"{' '.join(map(str, tags))} {response.get('description', '')}".lower()))
+
+        score = 0.0
+        for words in keyword_words:
+            if words <= name_words:
+                score = score + 2
+            elif words <= other_words | name_words:
+                score = score + 1
+
+        try:
+            rating = float(response.get('rating') or 0)
+        except (TypeError, ValueError):
+            rating = 0.0
+        # the rating only decides between results which match the keywords equally well
+        score = score + min(max(rating, 0.0), 5.0) / 5
+        if 'google_data' in response:
+            score = score + 0.1
+        return score
+
+    def _estimate_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / _CHARS_PER_TOKEN)
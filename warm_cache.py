@@ -0,0 +1,105 @@
+"""Fills the places and image caches ahead of production traffic.
+
+Walks every TIH dataset page by page and enriches all records with google data, the same way a recommendation
+request does. Progress is saved to a checkpoint file after every page, an interrupted run continues where it
+stopped when started again.
+
+Usage:
+    python warm_cache.py [--datasets events shops] [--keywords ...] [--page-size 50] [--workers 4]
+"""
+import argparse
+import json
+import os
+import time
+
+from services import Services
+from tih_api.tih_api import TIHAPI
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Warm up the places and image caches for all TIH datasets.")
+    parser.add_argument("--keys", default="api_keys.json", help="api keys and settings file")
+    parser.add_argument("--datasets", nargs="*", help="datasets to warm up, defaults to all TIH datasets")
+    parser.add_argument("--keywords", nargs="*", default=[], help="search keywords used for every dataset")
+    parser.add_argument("--page-size", type=int, default=50, help="number of TIH records requested per page")
+    parser.add_argument("--workers", type=int, default=4, help="number of records enriched concurrently")
+    parser.add_argument("--max-pages", type=int, default=0, help="pages per dataset in this run, 0 for no limit")
+    parser.add_argument("--checkpoint", default="warm_cache_checkpoint.json", help="file to save the progress to")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    return parser.parse_args()
+
+
+def read_checkpoint(file_path: str) -> dict[str, dict]:
+    if not os.path.exists(file_path):
+        return dict()
+
+    with open(file_path, "r") as file:
+        return json.load(file).get('datasets', dict())
+
+
+def write_checkpoint(file_path: str, checkpoint: dict[str, dict]):
+    temp_file_path = f"{file_path}.tmp"
+    with open(temp_file_path, "w") as outfile:
+        outfile.write(json.dumps({'datasets': checkpoint}, indent=4))
+    os.replace(temp_file_path, file_path)
+
+
+def warm_dataset(tih_api: TIHAPI, dataset: str, keywords: list[str], page_size: int, max_pages: int,
+                 progress: dict, checkpoint: dict[str, dict], checkpoint_file: str):
+    state = checkpoint.setdefault(dataset, {'offset': 0, 'records': 0, 'matched': 0, 'done': False})
+    if state['done']:
+        print(f"{dataset}: already done ({state['records']} records, {state['matched']} matched)")
+        return
+
+    pages = 0
+    while max_pages == 0 or pages < max_pages:
+        page = tih_api.fetch_enriched_page([dataset], keywords, page_size, state['offset'])
+        matched = sum(1 for item in page if 'google_data' in item)
+        state['offset'] = state['offset'] + page_size
+        state['records'] = state['records'] + len(page)
+        state['matched'] = state['matched'] + matched
+        state['done'] = len(page) < page_size
+        write_checkpoint(checkpoint_file, checkpoint)
+
+        pages = pages + 1
+        progress['records'] = progress['records'] + len(page)
+        progress['matched'] = progress['matched'] + matched
+        elapsed = time.time() - progress['start']
+        print(f"{dataset}: offset={state['offset']} records={state['records']} matched={state['matched']} | "
+              f"total records={progress['records']} matched={progress['matched']} "
+              f"rate={progress['records'] / elapsed:.2f} records/s")
+
+        if state['done']:
+            return
+
+
+def main():
+    args = parse_arguments()
+    with open(args.keys, "r") as file:
+        keys = json.load(file)
+
+    # the refresh scheduler would spend the api budget on the places this run adds
+    services = Services(dict(keys, EnrichmentWorkers=args.workers, CacheRefreshEnabled=False))
+    tih_api = services.tih_api
+    places = services.places
+
+    checkpoint = dict() if args.restart else read_checkpoint(args.checkpoint)
+    datasets = args.datasets if args.datasets else tih_api.get_datasets()
+    progress = {'start': time.time(), 'records': 0, 'matched': 0}
+    try:
+        for dataset in datasets:
+            warm_dataset(tih_api, dataset, args.keywords, args.page_size, args.max_pages, progress, checkpoint,
+                         args.checkpoint)
+
+        print("waiting for image downloads...")
+        places.wait_for_images()
+    finally:
+        services.close()
+
+    done = sum(1 for dataset in datasets if checkpoint.get(dataset, {}).get('done', False))
+    print(f"warm up finished in {time.time() - progress['start']:.1f} seconds: {done}/{len(datasets)} datasets "
+          f"complete, {progress['records']} records enriched, {progress['matched']} matched")
+
+
+if __name__ == "__main__":
+    main()